@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the tests
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import os
+import sys
+import subprocess
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def run_python():
+    """
+    Run python with the given arguments in a fresh process, which imports
+    twissfit from this source tree.
+    """
+    def run(*args):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [REPO_DIR] + [path for path in [env.get('PYTHONPATH')] if path])
+        return subprocess.run([sys.executable] + list(args), capture_output=True, text=True, env=env)
+    return run
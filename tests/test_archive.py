@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the memory mapped profile archive
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import numpy as np
+import pytest
+from twissfit import archive, resultstore
+from twissfit.profilegriddata import ProfileGridData
+
+
+def convert_sim_files(directory, path, nfiles=4):
+    files = [ProfileGridData.write_sim_data(directory=str(directory)) for _ in range(nfiles)]
+    return files, archive.convert_csv_files(files, str(path), 47,
+                                            k_prime_l_quad=np.linspace(0.5, 0.8, nfiles))
+
+
+def test_convert(tmp_path):
+    files, profile_archive = convert_sim_files(tmp_path, tmp_path / 'archive')
+    assert len(profile_archive) == 4
+    assert profile_archive.index['filenames'] == files
+    xvals, yvals = ProfileGridData.read_profile_file(files[2], 47)
+    np.testing.assert_array_equal(profile_archive.x_values[2], xvals[:, 1])
+    np.testing.assert_array_equal(profile_archive.y_values[2], yvals[:, 1])
+
+
+def test_store_and_archive_do_not_share_directory(tmp_path):
+    _, profile_archive = convert_sim_files(tmp_path, tmp_path / 'archive')
+    assert archive.INDEX_FILENAME != resultstore.INDEX_FILENAME
+    with pytest.raises(ValueError):
+        resultstore.create_store(str(tmp_path / 'archive'), 4)
+    with pytest.raises(ValueError):
+        profile_archive.fit({'variant': 47, 'x_omit': [], 'y_omit': [], 'x_fit_params': [None] * 6,
+                             'y_fit_params': [None] * 6}, store=str(tmp_path / 'archive'))
+
+    resultstore.save_store(str(tmp_path / 'store'), ['a'], ['0'], [0.5], np.zeros((1, 2, 5)),
+                           np.zeros((1, 2, 5, 5)), np.zeros((1, 2)))
+    with pytest.raises(ValueError):
+        archive.create_archive(str(tmp_path / 'store'), [0.5], np.zeros((2, 3)))
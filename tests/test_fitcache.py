@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the on-disk fit cache
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import numpy as np
+import twissfit.__main__ as cli
+from twissfit.fitcache import FitCache, DIRECTIONS
+from twissfit.profilegriddata import ProfileGridData
+
+
+def get_fit_results():
+    return {direction: (np.arange(3.), np.ones(3), np.zeros(5), np.eye(5), np.ones(2), (0, 3))
+            for direction in DIRECTIONS}
+
+
+def count_scans(monkeypatch):
+    scans = []
+    scan = FitCache._scan
+
+    def counted_scan(self):
+        scans.append(self.directory)
+        return scan(self)
+    monkeypatch.setattr(FitCache, '_scan', counted_scan)
+    return scans
+
+
+def test_put_scans_once(tmp_path, monkeypatch):
+    scans = count_scans(monkeypatch)
+    cache = FitCache(str(tmp_path), maxsize=100)
+    for idx in range(20):
+        cache.put('key{}'.format(idx), get_fit_results())
+    assert len(scans) == 1
+    assert cache._count == 20
+
+
+def test_put_evicts_in_batches(tmp_path, monkeypatch):
+    scans = count_scans(monkeypatch)
+    cache = FitCache(str(tmp_path), maxsize=100)
+    for idx in range(200):
+        cache.put('key{}'.format(idx), get_fit_results())
+    # first count, then one eviction at put 101 and every 11 puts after it,
+    # when the count goes from the low water mark 90 above the size again
+    assert len(scans) == 1 + 10
+    assert len(list(tmp_path.glob('*.npz'))) <= 100
+
+
+def test_process_single_file_shares_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(cli, '_fit_cache', None)
+    scans = count_scans(monkeypatch)
+    init_dict = {'x_omit': [], 'y_omit': [], 'variant': 47,
+                 'x_fit_params': [None] * 6, 'y_fit_params': [None] * 6}
+    for _ in range(5):
+        filename = ProfileGridData.write_sim_data(directory=str(tmp_path))
+        cli.process_single_file(filename, init_dict, plot=False)
+    assert len(scans) == 1
+    assert cli.get_fit_cache()._count == 5
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the profile grid data reader
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import numpy as np
+import pytest
+from twissfit.profilegriddata import ProfileGridData
+
+# skip_header, skip_footer and y skip_header of the former genfromtxt reader
+GENFROMTXT_LAYOUT = {47: (5, 62, 67), 77: (5, 78, 83), 96: (5, 1, None)}
+
+
+def read_genfromtxt(filename, variant):
+    skip_header, skip_footer, y_skip_header = GENFROMTXT_LAYOUT[variant]
+    xvals = np.genfromtxt(filename, delimiter=',',
+                          skip_header=skip_header, skip_footer=skip_footer)
+    if y_skip_header is None:
+        return xvals, np.zeros((95, 2))
+    return xvals, np.genfromtxt(filename, delimiter=',', skip_header=y_skip_header)
+
+
+def write_96_point_file(directory, footer):
+    positions = ProfileGridData.get_sim_positions(95)
+    values = ProfileGridData.fit_function(positions, 0, 0, 1000, 3, 5)
+    filename = str(directory / '96.csv')
+    with open(filename, 'w') as f:
+        f.write('device:\nSIMULATION\ngain:\nSIMULATION\nx-values: (sim)\n')
+        f.write(''.join('{}, {}\n'.format(*row) for row in zip(positions, values)))
+        f.write(footer)
+    return filename
+
+
+@pytest.mark.parametrize('variant, npoints', [(47, None), (77, 77)])
+def test_read_profile_file(tmp_path, variant, npoints):
+    filename = ProfileGridData.write_sim_data(npoints, str(tmp_path))
+    for expected, actual in zip(read_genfromtxt(filename, variant),
+                                ProfileGridData.read_profile_file(filename, variant)):
+        np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('footer', ['y-values:\n', 'end of data\n'])
+def test_read_96_point_file(tmp_path, footer):
+    filename = write_96_point_file(tmp_path, footer)
+    for expected, actual in zip(read_genfromtxt(filename, 96),
+                                ProfileGridData.read_profile_file(filename, 96)):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_parse_without_headers():
+    text = b'device:\nSIMULATION\ngain:\nSIMULATION\nno header\n' + \
+        b''.join(b'%d, %d\n' % (idx, idx) for idx in range(61)) + b'no header\n' + \
+        b''.join(b'%d, %d\n' % (idx, 2 * idx) for idx in range(61))
+    xvals, yvals = ProfileGridData.parse_profile_bytes(text, 47)
+    np.testing.assert_array_equal(xvals[:, 1], np.arange(61))
+    np.testing.assert_array_equal(yvals[:, 1], 2 * np.arange(61))
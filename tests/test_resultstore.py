@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the binary result store
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import numpy as np
+from twissfit.resultstore import save_store, load_store, get_result_matrix
+
+
+def write_test_store(path, k_prime_l_quad):
+    nrows = len(k_prime_l_quad)
+    popt = np.zeros((nrows, 2, 5))
+    popt[..., 4] = 2
+    save_store(str(path), ['{}.csv'.format(idx) for idx in range(nrows)], ['0'] * nrows,
+               k_prime_l_quad, popt, np.zeros((nrows, 2, 5, 5)), np.ones((nrows, 2)))
+
+
+def test_round_trip(tmp_path):
+    write_test_store(tmp_path, [0.5, 0.6, 0.7])
+    index, columns = load_store(str(tmp_path))
+    assert index['filenames'] == ['0.csv', '1.csv', '2.csv']
+    np.testing.assert_array_equal(get_result_matrix(columns),
+                                  [[0.5, 2, 2], [0.6, 2, 2], [0.7, 2, 2]])
+
+
+def test_load_store_without_k_prime_l(tmp_path, run_python):
+    # as written by -d --store
+    write_test_store(tmp_path, [np.nan] * 4)
+    proc = run_python('-m', 'twissfit', '--load-store', str(tmp_path))
+    assert proc.returncode == 1
+    assert 'at least 3 are needed' in proc.stdout
+    assert 'Traceback' not in proc.stderr
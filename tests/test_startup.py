@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+Guards against slow start up of the command line tool
+
+twissfit is called once per acquisition from shell scripts, so importing
+it must not pull in the heavy dependencies.
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import time
+import pytest
+
+# wall time over a bare interpreter, generous to avoid flaky failures
+STARTUP_LIMIT = 1.0  # s
+
+LIST_MODULES = 'import sys, {}; print(" ".join(sorted(sys.modules)))'
+
+
+@pytest.mark.parametrize('module, forbidden', [
+    ('twissfit', ('scipy', 'matplotlib')),
+    ('twissfit.__main__', ('numpy', 'scipy', 'matplotlib', 'PyPDF2'))])
+def test_no_heavy_imports(run_python, module, forbidden):
+    proc = run_python('-c', LIST_MODULES.format(module))
+    assert proc.returncode == 0, proc.stderr
+    heavy = [name for name in proc.stdout.split() if name.split('.')[0] in forbidden]
+    assert not heavy
+
+
+def test_startup_time(run_python):
+    def best_time(*args):
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            assert run_python(*args).returncode == 0
+            times.append(time.perf_counter() - start)
+        return min(times)
+    overhead = best_time('-m', 'twissfit', '--version') - best_time('-c', 'pass')
+    assert overhead < STARTUP_LIMIT
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the TWISS parameter calculations
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import time
+import numpy as np
+from twissfit import twiss
+
+
+def test_design_matrices_cached_keeps_shape():
+    twiss.clear_cache()
+    k_prime_l_quad = np.tile([0.3, 0.5, 0.7, 0.9, 1.1, 1.3], (4, 1))
+    for kl in (k_prime_l_quad.ravel(), k_prime_l_quad, k_prime_l_quad[0]):
+        design = twiss.get_design_matrices_cached(kl)
+        np.testing.assert_allclose(design, twiss.get_design_matrices(kl))
+    # one entry per distinct K'L, shared by all shapes
+    assert twiss.get_cache_info()['currsize'] == 6
+    assert twiss.get_cache_info()['misses'] == 6
+
+
+def test_design_matrices_cached_bounded():
+    twiss.clear_cache()
+    k_prime_l_quad = np.linspace(0.3, 1.5, 10 * twiss.MATRIX_CACHE_SIZE)
+    design = twiss.get_design_matrices_cached(k_prime_l_quad)
+    np.testing.assert_allclose(design, twiss.get_design_matrices(k_prime_l_quad))
+    assert twiss.get_cache_info()['currsize'] == 0
+
+
+def test_solve_scales_linearly():
+    # repeated copies like np.append would give an exponent of about 2
+    sizes = (20000, 200000)
+    seconds = []
+    for nfiles in sizes:
+        result_matrix = np.column_stack((np.linspace(0.3, 1.5, nfiles),
+                                         np.random.default_rng(1).uniform(2, 10, (nfiles, 2))))
+        latencies = []
+        for _ in range(5):
+            start = time.perf_counter()
+            twiss.solve_equation_system(result_matrix)
+            latencies.append(time.perf_counter() - start)
+        # the fastest run is the least disturbed one
+        seconds.append(min(latencies))
+    exponent = np.log(seconds[1] / seconds[0]) / np.log(sizes[1] / sizes[0])
+    assert 0.7 < exponent < 1.3
+
+
+def test_uncertainty_independent_of_chunks():
+    k_prime_l_quad = np.linspace(0.5, 1.2, 8)
+    xfer_hor, xfer_vert = twiss.get_xfer_batch(k_prime_l_quad, twiss.L_DRIFT)
+    beta_x, _, _ = twiss.transform_batch(12.7, 9.3, xfer_hor)
+    beta_y, _, _ = twiss.transform_batch(14.4, -0.85, xfer_vert)
+    result_matrix = np.column_stack((k_prime_l_quad, twiss.get_sigma(beta_x, 20.3),
+                                     twiss.get_sigma(beta_y, 4.04)))
+    sigma_errors = np.full((8, 2), 0.05)
+    expected = twiss.get_twiss_uncertainty(result_matrix, sigma_errors, nsamples=2500, seed=1)
+    for chunk_size in (1, 1000, 1500):
+        result = twiss.get_twiss_uncertainty(result_matrix, sigma_errors, nsamples=2500,
+                                             seed=1, chunk_size=chunk_size)
+        for actual, wanted in zip(result, expected):
+            np.testing.assert_array_equal(actual, wanted)
+    # beta within a few standard errors of the truth
+    np.testing.assert_allclose(expected[0][0], (12.7, 14.4), rtol=0.05)
@@ -14,11 +14,146 @@ import sys
 import argparse
 import json
 import logging as log
-import numpy as np
-from PyPDF2 import PdfFileMerger
-from twissfit.twiss import *
 from twissfit.version import __version__
-from twissfit.profilegriddata import ProfileGridData
+
+# numpy, scipy, matplotlib and PyPDF2 are imported only where needed,
+# to keep the startup time short
+
+# fit cache of this process, see get_fit_cache
+_fit_cache = None
+
+
+def get_fit_cache():
+    """
+    One fit cache per process, also in the workers, so the cache directory
+    is scanned only once and not for every file.
+    """
+    global _fit_cache
+    if _fit_cache is None:
+        from twissfit.fitcache import FitCache
+        _fit_cache = FitCache()
+    return _fit_cache
+
+
+def process_single_file(file, init_dict, plot=True, use_cache=True, in_memory=False):
+    """
+    Returns the results of process_horiz_and_vert and a summary with the
+    file hash and the fit results for the result store. With in_memory, the
+    plots are returned as PDF bytes in place of the plot file names.
+    """
+    from twissfit.profilegriddata import ProfileGridData
+    from twissfit.profiling import profiler
+    if profiler.enabled:
+        # the in memory plots are rendered after process_horiz_and_vert
+        ProfileGridData.warm_up(plot=plot)
+    cache = get_fit_cache() if use_cache else None
+    grid_data = ProfileGridData(file, init_dict)
+    result = grid_data.process_horiz_and_vert(
+        plot=plot and not in_memory, cache=cache)
+    if plot and in_memory:
+        result = result[:4] + tuple(grid_data.render_plots(in_memory=True))
+    return result, (grid_data.file_hash,) + grid_data.get_fit_summary()
+
+
+def _process_single_file_profiled(file, init_dict, plot, use_cache, in_memory, memory):
+    # runs in a worker process, the records are merged by the caller
+    from twissfit.profiling import profiler
+    profiler.enable(memory=memory)
+    profiler.reset()
+    result = process_single_file(file, init_dict, plot, use_cache, in_memory)
+    return result, profiler.records
+
+
+def write_store(path, files, k_prime_l_quad, summaries, twiss=None):
+    import numpy as np
+    from twissfit.resultstore import save_store
+    file_hashes, popt, pcov, area = zip(*summaries)
+    save_store(path, files, file_hashes, k_prime_l_quad, np.array(popt),
+               np.array(pcov), np.array(area), twiss=twiss)
+    log.info('Results stored in {}'.format(path))
+
+
+def process_files(files, init_dict, jobs=1, plot=True, use_cache=True, in_memory=False):
+    """
+    Read, fit and plot all files, optionally on a pool of worker
+    processes. The results are returned in the order of the files.
+    """
+    if jobs is not None and jobs <= 0:
+        jobs = os.cpu_count()
+    if not jobs or jobs == 1 or len(files) < 2:
+        return [process_single_file(file, init_dict, plot, use_cache, in_memory) for file in files]
+    from concurrent.futures import ProcessPoolExecutor
+    from twissfit.profiling import profiler
+    with ProcessPoolExecutor(max_workers=min(jobs, len(files))) as executor:
+        if not profiler.enabled:
+            return list(executor.map(process_single_file, files, [init_dict] * len(files), [plot] * len(files),
+                                     [use_cache] * len(files), [in_memory] * len(files)))
+        results = []
+        for result, records in executor.map(_process_single_file_profiled, files, [init_dict] * len(files),
+                                            [plot] * len(files), [use_cache] * len(files),
+                                            [in_memory] * len(files), [profiler.memory] * len(files)):
+            results.append(result)
+            profiler.records.extend(records)
+        return results
+
+
+def watch_directory(directory, init_dict, plot=True, use_cache=True, lattice=None, interval=1.0):
+    """
+    Fit new profile grid files as they appear in the directory and update
+    the Twiss parameters after each file. The file names must contain the
+    K'L value like with the -c switch. A file is processed once its size
+    stays the same between two polls.
+    """
+    import time
+    import glob
+    from twissfit.twiss import IncrementalTwissSolver
+    solver = IncrementalTwissSolver(lattice=lattice)
+    seen = set()
+    sizes = {}
+    while True:
+        # files may vanish between listing and stat, e.g. temporary files
+        mtimes = {}
+        for file in glob.glob(os.path.join(directory, '*.csv')):
+            try:
+                mtimes[file] = os.path.getmtime(file)
+            except OSError:
+                continue
+        for file in sorted(mtimes, key=mtimes.get):
+            if file in seen:
+                continue
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                sizes.pop(file, None)
+                continue
+            if sizes.get(file) != size:
+                # probably still being written
+                sizes[file] = size
+                continue
+            seen.add(file)
+            sizes.pop(file)
+            try:
+                k_prime_l_quad = float(os.path.basename(file)[:4])
+            except ValueError:
+                log.error(
+                    'Skipping {}, the first 4 digits of the file name must contain a valid float.'.format(file))
+                continue
+            try:
+                result, _ = process_single_file(
+                    file, init_dict, plot, use_cache)
+                mean_x, mean_y, sigma_x, sigma_y, _, _ = result
+            except Exception as e:
+                log.error('Skipping {}, {}'.format(file, e))
+                continue
+            solver.add(k_prime_l_quad, sigma_x, sigma_y)
+            result = solver.solve()
+            if result is None:
+                print('{} files, need at least 3 to solve.'.format(solver.nrows))
+                continue
+            beta, alpha, gamma, eps = result
+            print('{} files: beta_x = {}, alpha_x = {}, eps_x = {}, beta_y = {}, alpha_y = {}, eps_y = {}'.format(
+                solver.nrows, beta[0], alpha[0], eps[0], beta[1], alpha[1], eps[1]))
+        time.sleep(interval)
 
 
 def main():
@@ -39,6 +174,30 @@ def main():
                         help="File name contains the K'L value.")
     parser.add_argument('-i', '--init', nargs='?', type=str, default=None,
                         help="Name of the initialiser JSON file.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of parallel worker processes for -d and -p. 0 uses all cores.")
+    parser.add_argument('--no-plots', action='store_true', default=False,
+                        help="Only fit and solve, do not create any plots.")
+    parser.add_argument('-u', '--uncertainty', nargs=1, type=int,
+                        help="Number of Monte Carlo samples for the uncertainties of the Twiss parameters in -p mode.")
+    parser.add_argument('--map', nargs=2, type=int, metavar=('N_KL', 'N_DIST'),
+                        help="In -p mode, calculate a 2D map of sigma over N_KL quadrupole strengths and N_DIST distances, store it as sigma_map.npy and report the minima.")
+    parser.add_argument('--optimize', action='store_true', default=False,
+                        help="In -p mode, find the K'L that minimizes sigma_x, sigma_y and both at the profile grid.")
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help="Do not use the on-disk fit cache, fit all files again.")
+    parser.add_argument('--store', nargs=1, type=str,
+                        help="Write fit and Twiss results of -d or -p to a binary result store directory.")
+    parser.add_argument('--load-store', nargs=1, type=str,
+                        help="Solve the Twiss parameters from a result store instead of fitting files.")
+    parser.add_argument('-w', '--watch', nargs=1, type=str,
+                        help="Watch a directory for new files and update the solution after each file. File names must contain the K'L value.")
+    parser.add_argument('--profile', nargs=1, type=str,
+                        help="Record time per stage and file and write a JSON summary to this file at the end.")
+    parser.add_argument('--profile-memory', action='store_true', default=False,
+                        help="With --profile, also record the peak memory per stage. Makes the run slower.")
+    parser.add_argument('--cprofile', nargs=1, type=str,
+                        help="Run under cProfile and write the statistics to this file for pstats or snakeviz.")
 
     args = parser.parse_args()
 
@@ -50,16 +209,34 @@ def main():
         print('{} {}'.format(scriptname, __version__))
         sys.exit()
 
+    # the results are written on exit, so every sys.exit below is covered
+    if args.profile:
+        import atexit
+        from twissfit.profiling import profiler
+        profiler.enable(memory=args.profile_memory)
+        atexit.register(profiler.write_summary, args.profile[0])
+
+    if args.cprofile:
+        import atexit
+        import cProfile
+        cprofiler = cProfile.Profile()
+        atexit.register(cprofiler.dump_stats, args.cprofile[0])
+        atexit.register(cprofiler.disable)
+        cprofiler.enable()
+
     if args.contains:
         contains = True
 
     if args.sim:
+        from twissfit.profilegriddata import ProfileGridData
         nsim = int(args.sim[0])
         log.info('Creating {} simulated data files.'.format(nsim))
         for i in range(nsim):
             ProfileGridData.write_sim_data()
         sys.exit()
 
+    # beam line from the init file, None means the default of twissfit.twiss
+    lattice = None
     if args.init:
         try:
             with open(str(args.init), 'r') as f:
@@ -67,6 +244,13 @@ def main():
         except:
             print('Something wrong with the init file. Aborting.')
             sys.exit()
+        if 'lattice' in init_dict:
+            from twissfit.lattice import Lattice
+            try:
+                lattice = Lattice.from_init_dict(init_dict, args.init)
+            except (OSError, ValueError, KeyError) as e:
+                print('Something wrong with the lattice: {}. Aborting.'.format(e))
+                sys.exit()
     else:
         # put some default values here
         # [offset, slope, amp, mean, sigma, cut_range]
@@ -77,58 +261,87 @@ def main():
                      "y_fit_params": [None, None, None, None, None, None],
                      "variant": 47}
 
+    if args.store:
+        from twissfit.resultstore import check_store_path
+        try:
+            check_store_path(args.store[0])
+        except ValueError as e:
+            print('{} Aborting.'.format(e))
+            sys.exit(1)
+
+    if args.load_store:
+        import numpy as np
+        from twissfit.resultstore import load_store, get_result_matrix
+        from twissfit.twiss import solve_equation_system
+        try:
+            index, columns = load_store(args.load_store[0])
+        except (OSError, ValueError, KeyError) as e:
+            print('Something wrong with the result store: {}. Aborting.'.format(e))
+            sys.exit(1)
+        result_matrix = get_result_matrix(columns)
+        # stores written with -d have no K'L, failed fits no sigma
+        usable = np.isfinite(result_matrix).all(axis=1)
+        if usable.sum() < 3:
+            print('The result store has {} rows with a valid K\'L and sigma, at least 3 are needed. Aborting.'.format(
+                usable.sum()))
+            sys.exit(1)
+        beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y = solve_equation_system(
+            result_matrix[usable], lattice=lattice)
+        print('beta_x = {}, alpha_x = {}, eps_x = {}, beta_y = {}, alpha_y = {}, eps_y = {}'.format(
+            beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y))
+        sys.exit()
+
+    if args.watch:
+        try:
+            watch_directory(args.watch[0], init_dict, plot=not args.no_plots,
+                            use_cache=not args.no_cache, lattice=lattice)
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
     # draw and process come at least, draw before process
     if args.draw:
-        files = args.draw
-        for file in files:
-            grid_data = ProfileGridData(file, init_dict)
-            grid_data.process_horiz_and_vert()
+        results = process_files(args.draw, init_dict, jobs=args.jobs,
+                                plot=not args.no_plots, use_cache=not args.no_cache)
+        if args.store:
+            # K'L is not known when only drawing
+            write_store(args.store[0], args.draw, [float('nan')] * len(args.draw),
+                        [summary for _, summary in results])
         sys.exit()
 
     if args.process:
+        import numpy as np
+        from twissfit.twiss import solve_equation_system, plot_sigma_vs_distance, plot_sigma_vs_k_prime_l
         files = args.process
         nfiles = len(files)
         nfiles_min = 3
         ntries = 4
-        plot_filenames = []
+        pages = []
         if nfiles < nfiles_min:
             log.error(
                 'Please provide at least {} files.'.format(nfiles_min))
             sys.exit()
-        result_matrix = np.array([], dtype=np.float64)
+        result_matrix = np.zeros((nfiles, 3), dtype=np.float64)
 
+        # collect all K'L values first, then process the files
         if contains:
-            for file in files:
+            for idx, file in enumerate(files):
                 try:
-                    k_prime_l_quad = float(file[:4])
+                    result_matrix[idx, 0] = float(file[:4])
                 except:
                     log.error(
                         'When using the -c switch, the first 4 digits of the file name must contain a valid float. Aborting.')
                     sys.exit()
-                grid_data = ProfileGridData(file, init_dict)
-                mean_x, mean_y, sigma_x, sigma_y, plot_filename_hor, plot_filename_vert = grid_data.process_horiz_and_vert()
-                result_matrix = np.append(
-                    result_matrix, (k_prime_l_quad, sigma_x, sigma_y))
-                plot_filenames.extend(
-                    [plot_filename_hor, plot_filename_vert])
-                # sys.exit()
 
         else:
 
-            for file in files:
+            for idx, file in enumerate(files):
                 for i in reversed(range(ntries)):
 
                     try:
                         # make sure the user input values are all positive
-                        k_prime_l_quad = np.abs(float(
+                        result_matrix[idx, 0] = np.abs(float(
                             input("Please enter the K'L for {}: ".format(file))))
-                        grid_data = ProfileGridData(file, init_dict)
-                        sigma_x, sigma_y, plot_filename_hor, plot_filename_vert = grid_data.process_horiz_and_vert(
-                            verbose=False)
-                        result_matrix = np.append(
-                            result_matrix, (k_prime_l_quad, sigma_x, sigma_y))
-                        plot_filenames.extend(
-                            [plot_filename_hor, plot_filename_vert])
 
                     except (KeyboardInterrupt, EOFError) as e:
                         log.error('\nNothing to do.')
@@ -145,27 +358,101 @@ def main():
 
                     break
 
-        result_matrix = result_matrix.reshape((nfiles, 3))
+        # results come back in the order of the files
+        # the plots of all files are kept in memory for the report
+        results = process_files(files, init_dict, jobs=args.jobs, plot=not args.no_plots,
+                                use_cache=not args.no_cache, in_memory=True)
+        for idx, (result, _) in enumerate(results):
+            mean_x, mean_y, sigma_x, sigma_y, page_hor, page_vert = result
+            result_matrix[idx, 1:] = (sigma_x, sigma_y)
+            pages.extend([page_hor, page_vert])
+
         beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y = solve_equation_system(
-            result_matrix)
+            result_matrix, lattice=lattice)
 
         log.info('beta_x, alpha_x, eps_x', beta_x, alpha_x, eps_x)
         log.info('beta_y, alpha_y, eps_y', beta_y, alpha_y, eps_y)
 
-        plt_file_1 = plot_sigma_vs_distance(result_matrix, beta_x,
-                                            alpha_x, eps_x, beta_y, alpha_y, eps_y)
-        plt_file_2 = plot_sigma_vs_k_prime_l(result_matrix, beta_x,
-                                             alpha_x, eps_x, beta_y, alpha_y, eps_y)
-        plot_filenames.insert(0, plt_file_1)
-        plot_filenames.insert(0, plt_file_2)
-        # merge PDFs
-        merger = PdfFileMerger()
-        for pdf in plot_filenames:
-            merger.append(pdf)
-            os.remove(pdf)  # delete the file!
-        merger.write('{}_all.pdf'.format(
-            os.path.splitext(plot_filenames[2])[0]))
-        merger.close()
+        # the results are stored before the optional steps below
+        if args.store:
+            write_store(args.store[0], files, result_matrix[:, 0],
+                        [summary for _, summary in results],
+                        twiss={'beta_x': beta_x, 'alpha_x': alpha_x, 'eps_x': eps_x,
+                               'beta_y': beta_y, 'alpha_y': alpha_y, 'eps_y': eps_y})
+
+        from twissfit.profiling import profiler
+
+        if args.uncertainty:
+            from twissfit.twiss import get_twiss_uncertainty
+            # errors of sigma from the fit covariances
+            sigma_errors = np.sqrt(np.array(
+                [summary[2][:, 4, 4] for _, summary in results]))
+            with profiler.stage('uncertainty'):
+                mean, std, valid = get_twiss_uncertainty(
+                    result_matrix, sigma_errors, nsamples=args.uncertainty[0], jobs=args.jobs, lattice=lattice)
+            for plane, col in (('x', 0), ('y', 1)):
+                print('beta_{0} = {1} +/- {2}, alpha_{0} = {3} +/- {4}, eps_{0} = {5} +/- {6}, valid samples: {7:.1%}'.format(
+                    plane, mean[0, col], std[0, col], mean[1, col], std[1, col], mean[3, col], std[3, col], valid[col]))
+
+        if lattice is not None and (args.optimize or args.map):
+            log.warning(
+                'Optimizing and the sigma map are only available for the default beam line, skipping.')
+
+        if args.optimize and lattice is None:
+            from twissfit.twiss import optimize_k_prime_l
+            kl_range = (0.01, result_matrix[:, 0].max() * (1 + 0.1))
+            for name, weights in (('sigma_x', (1, 0)), ('sigma_y', (0, 1)), ('sigma_x^2 + sigma_y^2', (1, 1))):
+                try:
+                    with profiler.stage('optimize'):
+                        kl, sigma_x, sigma_y = optimize_k_prime_l(beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y,
+                                                                  weights=weights, kl_range=kl_range)
+                except ValueError as e:
+                    log.error('Minimum of {} not found: {}'.format(name, e))
+                    continue
+                print("Minimum of {}: K'L = {}, sigma_x = {}, sigma_y = {}".format(
+                    name, kl, sigma_x, sigma_y))
+
+        if args.map and lattice is None:
+            from twissfit.twiss import get_sigma_map, get_sigma_map_minima
+            # same ranges as in the plots
+            kl_iter = np.linspace(0.01, result_matrix[:, 0].max() * (1 + 0.1), args.map[0])
+            l_iter = np.linspace(0.1, 5, args.map[1])
+            # a failing map must not cost the report
+            try:
+                with profiler.stage('map'):
+                    sigma_map = get_sigma_map(kl_iter, l_iter, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y,
+                                              jobs=args.jobs, filename='sigma_map.npy')
+                for plane, (kl, ll, sigma) in zip(('x', 'y'), get_sigma_map_minima(sigma_map, kl_iter, l_iter)):
+                    print("Minimum sigma_{} = {} at K'L = {} and distance = {} m".format(
+                        plane, sigma, kl, ll))
+            except (ValueError, OSError) as e:
+                log.error('Sigma map failed: {}'.format(e))
+
+        if args.no_plots:
+            sys.exit()
+
+        from io import BytesIO
+        from twissfit.plotting import write_pdf_report
+        # the report is named after the horizontal plot of the first file
+        report_filename = '{}_Horizontal_all.pdf'.format(
+            os.path.splitext(files[0])[0])
+        summary_pages = []
+        if profiler.enabled:
+            from twissfit.plotting import warm_up
+            warm_up()
+        output = BytesIO()
+        with profiler.stage('plot_sigma'):
+            plot_sigma_vs_k_prime_l(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y,
+                                    lattice=lattice, output=output)
+        summary_pages.append(output.getvalue())
+        if lattice is None:
+            # distance plot only for the default beam line
+            output = BytesIO()
+            with profiler.stage('plot_sigma'):
+                plot_sigma_vs_distance(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y,
+                                       output=output)
+            summary_pages.append(output.getvalue())
+        write_pdf_report(summary_pages + pages, report_filename)
         sys.exit()
 
     log.error('Nothing to do.')
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Memory mapped profile archive for very large campaigns
+
+An archive is a directory with the profiles of one detector variant in a
+single fixed layout binary file, profiles.npy of shape (M, 2, channels)
+with the horizontal plane first, the channel positions of both planes in
+positions.npy, the K'L values in k_prime_l_quad.npy and an
+archive_index.json with the variant, file names and content hashes. The
+profiles are read through a memory map, so that fitting and solving can
+stream over the archive chunk by chunk with bounded memory. Result stores
+must be written to another directory:
+
+    python -m twissfit.archive convert -i init.json -o archive *.csv
+    python -m twissfit.archive fit -i init.json --store results archive
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import logging as log
+import numpy as np
+from twissfit.profilegriddata import ProfileGridData
+from twissfit.resultstore import is_store, create_store, write_index
+from twissfit.twiss import IncrementalTwissSolver
+
+PROFILES_FILENAME = 'profiles.npy'
+POSITIONS_FILENAME = 'positions.npy'
+K_PRIME_L_FILENAME = 'k_prime_l_quad.npy'
+INDEX_FILENAME = 'archive_index.json'
+ARCHIVE_VERSION = 1
+CHUNK_SIZE = 4096
+
+
+def get_k_prime_l_from_filename(filename):
+    """
+    K'L from the first 4 characters of the file name as with the -c
+    switch, NaN if there is none.
+    """
+    try:
+        return float(os.path.basename(filename)[:4])
+    except ValueError:
+        return float('nan')
+
+
+def is_archive(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+
+def create_archive(path, k_prime_l_quad, positions):
+    """
+    Create an archive with the K'L values and channel positions of shape
+    (2, channels). Returns the profiles as a writable memory map, the
+    archive is complete once write_archive_index has been called. Raises
+    a ValueError if the directory holds a result store.
+    """
+    if is_store(path):
+        raise ValueError(
+            '{} holds a result store, use another directory for the archive.'.format(path))
+    os.makedirs(path, exist_ok=True)
+    k_prime_l_quad = np.asarray(k_prime_l_quad, dtype=np.float64)
+    np.save(os.path.join(path, K_PRIME_L_FILENAME), k_prime_l_quad)
+    np.save(os.path.join(path, POSITIONS_FILENAME), positions)
+    return np.lib.format.open_memmap(os.path.join(path, PROFILES_FILENAME), mode='w+', dtype=np.float64,
+                                     shape=(len(k_prime_l_quad), 2, positions.shape[1]))
+
+
+def write_archive_index(path, variant, filenames, file_hashes):
+    index = {'version': ARCHIVE_VERSION,
+             'variant': variant,
+             'filenames': list(filenames),
+             'file_hashes': list(file_hashes)}
+    with open(os.path.join(path, INDEX_FILENAME), 'w') as f:
+        json.dump(index, f, indent=1)
+
+
+def convert_csv_files(files, path, variant, k_prime_l_quad=None):
+    """
+    Pack profile grid files, e.g. written by ProfileGridData.write_sim_data,
+    into an archive. All files must have the same channel positions. If no
+    K'L values are given, they are taken from the file names.
+    """
+    if k_prime_l_quad is None:
+        k_prime_l_quad = [get_k_prime_l_from_filename(file) for file in files]
+    profiles = None
+    file_hashes = []
+    for idx, file in enumerate(files):
+        with open(file, 'rb') as f:
+            text = f.read()
+        file_hashes.append(hashlib.sha1(text).hexdigest())
+        xvals, yvals = ProfileGridData.parse_profile_bytes(text, variant)
+        if profiles is None:
+            positions = np.stack((xvals[:, 0], yvals[:, 0]))
+            # written in place, only one file is in memory at a time
+            profiles = create_archive(path, k_prime_l_quad, positions)
+        elif xvals.shape[0] != positions.shape[1] or yvals.shape[0] != positions.shape[1] or \
+                not np.array_equal(xvals[:, 0], positions[0]) or not np.array_equal(yvals[:, 0], positions[1]):
+            raise ValueError(
+                'Channel positions of {} differ from the first file.'.format(file))
+        profiles[idx, 0] = xvals[:, 1]
+        profiles[idx, 1] = yvals[:, 1]
+    if profiles is not None:
+        profiles.flush()
+
+    write_archive_index(path, variant, files, file_hashes)
+    return ProfileArchive(path)
+
+
+class ProfileArchive(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILENAME), 'r') as f:
+            self.index = json.load(f)
+        self.variant = self.index['variant']
+        # read only memory maps, nothing is loaded here
+        self.profiles = np.load(os.path.join(
+            path, PROFILES_FILENAME), mmap_mode='r')
+        self.positions = np.load(os.path.join(path, POSITIONS_FILENAME))
+        self.k_prime_l_quad = np.load(os.path.join(
+            path, K_PRIME_L_FILENAME), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.profiles)
+
+    @property
+    def x_values(self):
+        """
+        Horizontal profiles of shape (M, channels), a view without copy.
+        """
+        return self.profiles[:, 0]
+
+    @property
+    def y_values(self):
+        return self.profiles[:, 1]
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """
+        Yields the row range, the K'L and the horizontal and vertical
+        profiles of consecutive chunks.
+        """
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            yield (start, stop, self.k_prime_l_quad[start:stop],
+                   self.profiles[start:stop, 0], self.profiles[start:stop, 1])
+
+    def fit(self, init_dict, chunk_size=CHUNK_SIZE, store=None, lattice=None):
+        """
+        Fit all profiles with ProfileGridData.fit_batch and solve for the
+        Twiss parameters chunk by chunk. Rows without a valid K'L are fitted
+        but not used for the solution. With store, the fit results are
+        written into a result store instead of being kept in memory.
+
+        Returns the result columns as in twissfit.resultstore and the
+        solution of IncrementalTwissSolver, None if it cannot be solved.
+        """
+        if init_dict['variant'] != self.variant:
+            raise ValueError('Archive has variant {}, init file {}.'.format(
+                self.variant, init_dict['variant']))
+        estimate = init_dict.get('estimate', False)
+        x_mask = ProfileGridData.get_channel_mask(
+            self.positions[0], init_dict['x_omit'])
+        y_mask = ProfileGridData.get_channel_mask(
+            self.positions[1], init_dict['y_omit'])
+
+        if store is None:
+            columns = {'k_prime_l_quad': np.array(self.k_prime_l_quad),
+                       'popt': np.empty((len(self), 2, 5)),
+                       'pcov': np.empty((len(self), 2, 5, 5)),
+                       'area': np.empty((len(self), 2))}
+        else:
+            columns = create_store(store, len(self))
+            columns['k_prime_l_quad'][:] = self.k_prime_l_quad
+
+        solver = IncrementalTwissSolver(lattice=lattice)
+        for start, stop, kl, x_values, y_values in self.iter_chunks(chunk_size):
+            for plane, values, mask, fit_params in ((0, x_values, x_mask, init_dict['x_fit_params']),
+                                                    (1, y_values, y_mask, init_dict['y_fit_params'])):
+                popt, pcov, area = ProfileGridData.fit_batch(
+                    self.positions[plane], values, fit_params, valid=mask, estimate=estimate)
+                columns['popt'][start:stop, plane] = popt
+                columns['pcov'][start:stop, plane] = pcov
+                columns['area'][start:stop, plane] = area
+            sigma = np.abs(columns['popt'][start:stop, :, 4])
+            usable = np.isfinite(kl) & np.isfinite(sigma).all(axis=1)
+            solver.add_batch(kl[usable], sigma[usable, 0], sigma[usable, 1])
+            log.info('Fitted {} of {} profiles.'.format(stop, len(self)))
+
+        solution = solver.solve()
+        if store is not None:
+            twiss = None
+            if solution is not None:
+                beta, alpha, gamma, eps = solution
+                twiss = {'beta_x': beta[0], 'alpha_x': alpha[0], 'eps_x': eps[0],
+                         'beta_y': beta[1], 'alpha_y': alpha[1], 'eps_y': eps[1]}
+            for column in columns.values():
+                column.flush()
+            write_index(store, self.index['filenames'],
+                        self.index['file_hashes'], twiss)
+        return columns, solution
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert profile grid files into a memory mapped archive and fit it.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Increase output verbosity')
+    subparsers = parser.add_subparsers(dest='command')
+    convert_parser = subparsers.add_parser(
+        'convert', help='Pack profile grid files into an archive.')
+    convert_parser.add_argument('files', nargs='+', type=str)
+    convert_parser.add_argument('-i', '--init', type=str, required=True,
+                                help='Name of the init file.')
+    convert_parser.add_argument('-o', '--output', type=str, required=True,
+                                help='Directory of the archive.')
+    fit_parser = subparsers.add_parser(
+        'fit', help='Fit an archive and solve for the Twiss parameters.')
+    fit_parser.add_argument('archive', type=str)
+    fit_parser.add_argument('-i', '--init', type=str, required=True,
+                            help='Name of the init file.')
+    fit_parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Number of profiles fitted at once.')
+    fit_parser.add_argument('--store', type=str, default=None,
+                            help='Write the fit results to a result store in this directory.')
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.basicConfig(level=log.INFO)
+    if args.command is None:
+        parser.print_help()
+        sys.exit()
+
+    with open(args.init, 'r') as f:
+        init_dict = json.load(f)
+
+    try:
+        if args.command == 'convert':
+            archive = convert_csv_files(args.files, args.output, init_dict['variant'])
+            print('{} profiles written to {}'.format(len(archive), args.output))
+            return
+
+        from twissfit.lattice import Lattice
+        lattice = Lattice.from_init_dict(init_dict, args.init)
+        archive = ProfileArchive(args.archive)
+        _, solution = archive.fit(init_dict, chunk_size=args.chunk_size,
+                                  store=args.store, lattice=lattice)
+    except ValueError as e:
+        print('{} Aborting.'.format(e))
+        sys.exit(1)
+    if solution is None:
+        print('Need at least 3 profiles with a valid K\'L to solve.')
+        return
+    beta, alpha, gamma, eps = solution
+    print('beta_x = {}, alpha_x = {}, eps_x = {}, beta_y = {}, alpha_y = {}, eps_y = {}'.format(
+        beta[0], alpha[0], eps[0], beta[1], alpha[1], eps[1]))
+
+
+if __name__ == '__main__':
+    main()
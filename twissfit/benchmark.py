@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for reading, fitting, solving and plotting
+
+Generates synthetic campaigns with ProfileGridData.write_sim_data and
+reports throughput, latency percentiles and optionally peak memory per
+stage. The results are written as JSON for comparison between versions:
+
+    python -m twissfit.benchmark --sizes 10 1000 --variants 47 77 96 -o bench.json
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import warnings
+import subprocess
+import tracemalloc
+import logging as log
+import numpy as np
+from twissfit.version import __version__
+from twissfit.profilegriddata import ProfileGridData
+from twissfit import twiss
+
+# number of points per profile for each variant
+VARIANT_NPOINTS = {47: 47, 77: 77, 96: 95}
+# campaign sizes and largest allowed exponent of the solve time over size
+SCALING_SIZES = (1000, 10000, 100000)
+SCALING_MAX_EXPONENT = 1.3
+# start up time of the command line tool above a bare interpreter
+STARTUP_THRESHOLD = 0.2  # s
+# must not be imported by 'python -m twissfit --version'
+HEAVY_MODULES = ('numpy', 'scipy', 'matplotlib', 'PyPDF2')
+
+
+def get_init_dict(variant):
+    return {"x_omit": [],
+            "y_omit": [],
+            "x_fit_params": [None, None, None, None, None, None],
+            "y_fit_params": [None, None, None, None, None, None],
+            "variant": variant}
+
+
+def summarize(latencies, total=None, peak_memory=None):
+    """
+    Throughput and latency percentiles of a stage from the latencies of the
+    single items in seconds.
+    """
+    latencies = np.asarray(latencies)
+    total = latencies.sum() if total is None else total
+    if not len(latencies):
+        # e.g. no plots with --plot-limit 0
+        return {'count': 0, 'total_s': total, 'throughput_per_s': None, 'latency_ms': None}
+    summary = {'count': len(latencies),
+               'total_s': total,
+               'throughput_per_s': len(latencies) / total if total > 0 else None,
+               'latency_ms': {'p50': np.percentile(latencies, 50) * 1e3,
+                              'p90': np.percentile(latencies, 90) * 1e3,
+                              'p99': np.percentile(latencies, 99) * 1e3,
+                              'max': latencies.max() * 1e3}}
+    if peak_memory is not None:
+        summary['peak_memory_mb'] = peak_memory / 2**20
+    return summary
+
+
+def run_stage(func, items, memory=False, catch=()):
+    """
+    Call func for every item and summarize. Exceptions of the types in
+    catch are counted as failures, the result of that item is then None.
+    Returns the summary and the results of the calls.
+    """
+    if memory:
+        tracemalloc.start()
+    latencies = np.empty(len(items))
+    results = []
+    failures = 0
+    for idx, item in enumerate(items):
+        start = time.perf_counter()
+        try:
+            results.append(func(item))
+        except catch as e:
+            log.info('Stage failed for {}: {}'.format(item, e))
+            results.append(None)
+            failures += 1
+        latencies[idx] = time.perf_counter() - start
+    peak_memory = None
+    if memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    summary = summarize(latencies, peak_memory=peak_memory)
+    if catch:
+        summary['failures'] = failures
+    return summary, results
+
+
+def get_startup_env():
+    # make sure this copy of twissfit is used, also when not installed
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, (package_dir, env.get('PYTHONPATH'))))
+    return env
+
+
+def benchmark_startup(repeat=5, args=('-m', 'twissfit', '--version')):
+    """
+    Wall time of 'python -m twissfit --version', i.e. the import overhead.
+    """
+    env = get_startup_env()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + list(args),
+                       stdout=subprocess.DEVNULL, check=True, env=env)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def check_startup(threshold=STARTUP_THRESHOLD, repeat=5):
+    """
+    Start up time of the command line tool compared to a bare interpreter
+    and the heavy modules it imports for --version, which should be none.
+    """
+    overhead = (benchmark_startup(repeat)['latency_ms']['p50'] -
+                benchmark_startup(repeat, ('-c', 'pass'))['latency_ms']['p50']) / 1e3
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'twissfit', '--version'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+                            env=get_startup_env(), universal_newlines=True).stderr
+    # lines look like 'import time: self | cumulative | module'
+    modules = {line.rsplit('|', 1)[-1].strip() for line in output.splitlines()
+               if line.startswith('import time:')}
+    heavy = sorted(module for module in modules if module.split('.')[0] in HEAVY_MODULES)
+    return {'overhead_s': overhead, 'threshold_s': threshold, 'heavy_modules': heavy,
+            'passed': bool(overhead <= threshold and not heavy)}
+
+
+def benchmark_campaign(nfiles, variant, directory, memory=False, plot_limit=10, solve_repeat=20):
+    init_dict = get_init_dict(variant)
+    npoints = VARIANT_NPOINTS[variant]
+    stages = {}
+
+    stages['write'], files = run_stage(
+        lambda idx: ProfileGridData.write_sim_data(npoints, directory), range(nfiles), memory)
+
+    def read(file):
+        grid_data = ProfileGridData(file, init_dict)
+        grid_data._read_data()
+        return grid_data
+    stages['read'], grid_datas = run_stage(read, files, memory)
+
+    def fit(file):
+        grid_data = ProfileGridData(file, init_dict)
+        return grid_data, grid_data.process_horiz_and_vert(plot=False)
+    # curve_fit gives up on some random profiles, these are counted
+    stages['fit'], fitted = run_stage(
+        fit, files, memory, catch=(RuntimeError, ValueError))
+    kl = np.linspace(0.3, 1.5, nfiles)
+    kl = np.array([kl[idx] for idx, item in enumerate(fitted) if item is not None])
+    fitted = [item for item in fitted if item is not None]
+
+    # all horizontal profiles in one batch
+    x_data = grid_datas[0].x_data[:, 0]
+    y_data = np.array([grid_data.x_data[:, 1] for grid_data in grid_datas])
+    stages['fit_batch'], _ = run_stage(
+        lambda y: ProfileGridData.fit_batch(x_data, y, init_dict['x_fit_params']), [y_data], memory)
+    stages['fit_batch']['profiles_per_s'] = nfiles / \
+        stages['fit_batch']['total_s']
+
+    result_matrix = np.column_stack((kl,
+                                     [result[2] for _, result in fitted],
+                                     [result[3] for _, result in fitted])).reshape((-1, 3))
+    if len(result_matrix) >= 3:
+        def solve_cold(result_matrix):
+            twiss.clear_cache()
+            return twiss.solve_equation_system(result_matrix)
+        stages['solve_cold'], _ = run_stage(
+            solve_cold, [result_matrix] * solve_repeat, memory)
+        # the matrix cache is filled now
+        stages['solve'], solutions = run_stage(
+            twiss.solve_equation_system, [result_matrix] * solve_repeat, memory)
+    else:
+        solutions = [(1, 0, 1, 1, 0, 1)]
+
+    plotted = fitted[:plot_limit]
+    stages['plot_fits'], _ = run_stage(
+        lambda item: item[0].render_plots(), plotted, memory)
+    beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y = solutions[0]
+    stages['plot_sigma'], _ = run_stage(
+        lambda plot: plot(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y),
+        [twiss.plot_sigma_vs_k_prime_l, twiss.plot_sigma_vs_distance], memory)
+    return stages
+
+
+def check_scaling(sizes=SCALING_SIZES, max_exponent=SCALING_MAX_EXPONENT, repeat=5):
+    """
+    Time filling the result matrix and solving for campaigns of the given
+    sizes and fit the exponent of time over size in a log-log plot. Linear
+    scaling gives about 1, repeated copies like np.append give about 2.
+    """
+    seconds = []
+    for nfiles in sizes:
+        sigmas = np.random.default_rng(1).uniform(2, 10, (nfiles, 2))
+        latencies = []
+        for _ in range(repeat):
+            twiss.clear_cache()
+            start = time.perf_counter()
+            result_matrix = np.zeros((nfiles, 3))
+            result_matrix[:, 0] = np.linspace(0.3, 1.5, nfiles)
+            for idx in range(nfiles):
+                result_matrix[idx, 1:] = sigmas[idx]
+            twiss.solve_equation_system(result_matrix)
+            latencies.append(time.perf_counter() - start)
+        # the fastest run is the least disturbed one
+        seconds.append(min(latencies))
+    exponent = np.polyfit(np.log(sizes), np.log(seconds), 1)[0]
+    return {'sizes': list(sizes), 'seconds': seconds, 'exponent': exponent,
+            'max_exponent': max_exponent, 'passed': bool(exponent <= max_exponent)}
+
+
+def run_checks():
+    """
+    Regression checks with thresholds. Returns the results and whether all
+    of them passed.
+    """
+    checks = {'scaling': check_scaling(),
+              'startup': check_startup()}
+    return checks, all(check['passed'] for check in checks.values())
+
+
+def run_benchmarks(sizes, variants, memory=False, plot_limit=10, workdir=None, startup=True):
+    results = {'twissfit_version': __version__,
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'platform': platform.platform(),
+               'campaigns': []}
+    if startup:
+        results['startup'] = benchmark_startup()
+    for variant in variants:
+        for nfiles in sizes:
+            with tempfile.TemporaryDirectory(dir=workdir) as directory:
+                cwd = os.getcwd()
+                # plots are written to the current directory
+                os.chdir(directory)
+                try:
+                    stages = benchmark_campaign(
+                        nfiles, variant, directory, memory=memory, plot_limit=plot_limit)
+                finally:
+                    os.chdir(cwd)
+            results['campaigns'].append({'variant': variant,
+                                         'nfiles': nfiles,
+                                         'stages': stages})
+            log.info('variant {} with {} files: {}'.format(variant, nfiles, ', '.join(
+                '{} {:.3g} s'.format(name, stage['total_s']) for name, stage in stages.items())))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark reading, fitting, solving and plotting of twissfit.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100],
+                        help='Number of files per campaign.')
+    parser.add_argument('--variants', nargs='+', type=int, default=[47],
+                        choices=sorted(VARIANT_NPOINTS), help='Detector variants.')
+    parser.add_argument('--memory', action='store_true', default=False,
+                        help='Measure peak memory per stage, makes timing slower.')
+    parser.add_argument('--plot-limit', type=int, default=10,
+                        help='Number of files for which fit plots are rendered.')
+    parser.add_argument('--workdir', type=str, default=None,
+                        help='Directory for the temporary campaign files.')
+    parser.add_argument('--no-startup', action='store_true', default=False,
+                        help='Do not measure the start up time of the command line tool.')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='Only run the regression checks, exit with an error if one fails.')
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json',
+                        help='Name of the JSON output file.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Increase output verbosity')
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.basicConfig(level=log.INFO)
+
+    # fits of noiseless or empty data warn a lot
+    warnings.simplefilter('ignore')
+    if args.check:
+        checks, passed = run_checks()
+        for name, check in checks.items():
+            print('{}: {}'.format(name, 'passed' if check['passed'] else 'FAILED'))
+        with open(args.output, 'w') as f:
+            json.dump(checks, f, indent=1, default=float)
+        sys.exit(0 if passed else 1)
+    results = run_benchmarks(args.sizes, args.variants, memory=args.memory,
+                             plot_limit=args.plot_limit, workdir=args.workdir,
+                             startup=not args.no_startup)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1, default=float)
+    print('Benchmark results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
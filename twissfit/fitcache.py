@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of fit results
+
+Entries are keyed by the content hash of a profile grid file together with
+the init_dict entries that influence the fit, so unchanged files are never
+fitted twice with the same settings.
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import os
+import time
+import json
+import hashlib
+import numpy as np
+
+FIT_CACHE_SIZE = 10000  # number of files
+# eviction removes entries down to this fraction of the size
+LOW_WATER_MARK = 0.9
+# temporary files older than this are left over from crashed writers
+TMP_MAX_AGE = 3600  # s
+DIRECTIONS = ('Horizontal', 'Vertical')
+# init_dict entries that change the fit results
+KEY_ENTRIES = ('variant', 'x_omit', 'y_omit',
+               'x_fit_params', 'y_fit_params', 'estimate')
+
+
+def get_default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'twissfit')
+
+
+def get_cache_key(file_hash, init_dict):
+    settings = json.dumps([init_dict.get(entry) for entry in KEY_ENTRIES])
+    return hashlib.sha1('{}|{}'.format(file_hash, settings).encode()).hexdigest()
+
+
+class FitCache(object):
+    """
+    Size bounded cache directory with one .npz file per profile grid file.
+    The number of entries is counted in memory, the directory is only
+    scanned when the count exceeds the size. Then the least recently used
+    entries are evicted down to the low water mark in one go.
+    """
+
+    def __init__(self, directory=None, maxsize=FIT_CACHE_SIZE):
+        self.directory = directory or get_default_cache_dir()
+        self.maxsize = maxsize
+        os.makedirs(self.directory, exist_ok=True)
+        # number of entries, None until the directory has been scanned
+        self._count = None
+
+    def _entry_filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns fit_results as in ProfileGridData or None.
+        """
+        filename = self._entry_filename(key)
+        try:
+            with np.load(filename) as data:
+                fit_results = {}
+                for direction in DIRECTIONS:
+                    fit_results[direction] = tuple(data['{}_{}'.format(direction, name)] for name in (
+                        'pos', 'grid', 'popt', 'pcov', 'area', 'fit_range'))
+            # mark as recently used
+            os.utime(filename)
+        except (OSError, KeyError, ValueError):
+            return None
+        return fit_results
+
+    def put(self, key, fit_results):
+        arrays = {}
+        for direction in DIRECTIONS:
+            pos, grid, popt, pcov, area, fit_range = fit_results[direction]
+            arrays.update({'{}_pos'.format(direction): pos,
+                           '{}_grid'.format(direction): grid,
+                           '{}_popt'.format(direction): popt,
+                           '{}_pcov'.format(direction): pcov,
+                           '{}_area'.format(direction): area,
+                           '{}_fit_range'.format(direction): np.asarray(fit_range)})
+        # write to a temporary file first, other processes may read
+        filename = self._entry_filename(key)
+        tmp_filename = '{}.{}.tmp.npz'.format(filename, os.getpid())
+        is_new = not os.path.exists(filename)
+        np.savez(tmp_filename, **arrays)
+        os.replace(tmp_filename, filename)
+        if self._count is None:
+            self._count = self._scan()[0]
+        elif is_new:
+            self._count += 1
+        if self._count > self.maxsize:
+            self.evict()
+
+    def _scan(self):
+        """
+        Number of entries and a list of entries and temporary files, which
+        can be removed.
+        """
+        entries = []
+        removable = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            if '.tmp.' in entry.name:
+                # other processes may still be writing recent ones
+                if now - mtime > TMP_MAX_AGE:
+                    removable.append(entry.path)
+            else:
+                entries.append((mtime, entry.path))
+        return len(entries), entries, removable
+
+    def evict(self, low_water_mark=LOW_WATER_MARK):
+        """
+        Remove the least recently used entries down to low_water_mark
+        times the size, and left over temporary files.
+        """
+        count, entries, removable = self._scan()
+        if count > self.maxsize:
+            entries.sort()
+            nremove = count - int(self.maxsize * low_water_mark)
+            removable.extend(path for _, path in entries[:nremove])
+            count -= nremove
+        for path in removable:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._count = count
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                os.remove(entry.path)
+        self._count = 0
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Beam line description with several elements
+
+The beam line is a sequence of drifts and thick quadrupoles with fringe
+fields, starting at the reference plane, where the Twiss parameters are
+determined, and ending at the profile grid. Exactly one quadrupole is
+scanned. The transfer matrices up- and downstream of it are calculated
+once, so that only the matrix of the scanned quadrupole has to be
+calculated for every K'L, regardless of the length of the beam line.
+
+A lattice can be read from a JSON file like:
+
+    {
+        "elements": [
+            {"type": "quad", "name": "Q1", "length": 1, "k_prime_l": -0.3},
+            {"type": "drift", "length": 1.5},
+            {"type": "quad", "name": "Q2", "length": 1, "i1a_norm": 0.00092, "scanned": true},
+            {"type": "drift", "length": 2.216}
+        ]
+    }
+
+Positive K'L is defocusing in the horizontal plane, like in twissfit.twiss.
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import os
+import json
+import numpy as np
+from twissfit.twiss import L_DRIFT, L_GEO_QUAD, I1A_NORM, get_drift_batch, \
+    get_twiss_matrix_batch, _flip_batch
+
+
+def get_quad_xfer_batch(k_prime_l_quad, length=L_GEO_QUAD, i1a_norm=I1A_NORM):
+    """
+    Horizontal and vertical stacked transfer matrices of a thick
+    quadrupole with fringe fields, for positive and negative K'L.
+    """
+    k_prime_l_quad = np.atleast_1d(np.asarray(k_prime_l_quad, dtype=np.float64))
+    nrows = len(k_prime_l_quad)
+    kappa_quad = np.sqrt(np.abs(k_prime_l_quad / length))
+    kl = kappa_quad * length
+    # K'L = 0 is a drift
+    safe_kappa = np.where(kappa_quad > 0, kappa_quad, 1)
+
+    defocusing = np.empty((nrows, 2, 2))
+    defocusing[:, 0, 0] = np.cosh(kl)
+    defocusing[:, 0, 1] = np.where(kappa_quad > 0, np.sinh(kl) / safe_kappa, length)
+    defocusing[:, 1, 0] = kappa_quad * np.sinh(kl)
+    defocusing[:, 1, 1] = defocusing[:, 0, 0]
+
+    focusing = np.empty((nrows, 2, 2))
+    focusing[:, 0, 0] = np.cos(kl)
+    focusing[:, 0, 1] = np.where(kappa_quad > 0, np.sin(kl) / safe_kappa, length)
+    focusing[:, 1, 0] = -kappa_quad * np.sin(kl)
+    focusing[:, 1, 1] = focusing[:, 0, 0]
+
+    positive = (k_prime_l_quad >= 0)[:, np.newaxis, np.newaxis]
+    mq_hor = np.where(positive, defocusing, focusing)
+    mq_vert = np.where(positive, focusing, defocusing)
+
+    ff = np.zeros((nrows, 2, 2))
+    ff[:, 0, 0] = 1 - i1a_norm * k_prime_l_quad / length
+    ff[:, 1, 1] = 1 + i1a_norm * k_prime_l_quad / length
+    ff_flip = _flip_batch(ff)
+    return ff_flip @ mq_hor @ ff, ff @ mq_vert @ ff_flip
+
+
+class Lattice(object):
+    def __init__(self, elements):
+        self.elements = elements
+        scanned = [idx for idx, element in enumerate(elements)
+                   if element.get('scanned', False)]
+        if len(scanned) != 1:
+            raise ValueError(
+                'The lattice must contain exactly one scanned quadrupole.')
+        self.scanned_idx = scanned[0]
+        self.scanned = elements[self.scanned_idx]
+        if self.scanned['type'] != 'quad':
+            raise ValueError('The scanned element must be a quadrupole.')
+
+        # precalculated matrices before and after the scanned element
+        self.upstream = self._get_section_xfer(elements[:self.scanned_idx])
+        self.downstream = self._get_section_xfer(
+            elements[self.scanned_idx + 1:])
+
+    @staticmethod
+    def _get_element_xfer(element):
+        if element['type'] == 'drift':
+            drift = get_drift_batch(element['length'])[0]
+            return drift, drift
+        if element['type'] == 'quad':
+            xfer_hor, xfer_vert = get_quad_xfer_batch(element['k_prime_l'], element.get(
+                'length', L_GEO_QUAD), element.get('i1a_norm', I1A_NORM))
+            return xfer_hor[0], xfer_vert[0]
+        raise ValueError('Unknown element type {}.'.format(element['type']))
+
+    @staticmethod
+    def _get_section_xfer(elements):
+        xfer_hor = np.eye(2)
+        xfer_vert = np.eye(2)
+        for element in elements:
+            element_hor, element_vert = Lattice._get_element_xfer(element)
+            xfer_hor = element_hor @ xfer_hor
+            xfer_vert = element_vert @ xfer_vert
+        return xfer_hor, xfer_vert
+
+    @classmethod
+    def default(cls):
+        """
+        The beam line of twissfit.twiss, one quadrupole and a drift.
+        """
+        return cls([{'type': 'quad', 'length': L_GEO_QUAD, 'i1a_norm': I1A_NORM, 'scanned': True},
+                    {'type': 'drift', 'length': L_DRIFT}])
+
+    @classmethod
+    def from_dict(cls, lattice_dict):
+        return cls(lattice_dict['elements'])
+
+    @classmethod
+    def from_json(cls, filename):
+        with open(filename, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def from_init_dict(cls, init_dict, init_filename=None):
+        """
+        Lattice given by the "lattice" entry of the init file, either inline
+        or as the name of a JSON file relative to the init file. Returns
+        None if there is no such entry.
+        """
+        lattice = init_dict.get('lattice')
+        if lattice is None:
+            return None
+        if isinstance(lattice, dict):
+            return cls.from_dict(lattice)
+        if init_filename is not None and not os.path.isabs(lattice):
+            lattice = os.path.join(os.path.dirname(init_filename), lattice)
+        return cls.from_json(lattice)
+
+    def get_xfer_batch(self, k_prime_l_quad):
+        """
+        Horizontal and vertical stacked transfer matrices from the
+        reference plane to the profile grid for an array of K'L.
+        """
+        quad_hor, quad_vert = get_quad_xfer_batch(k_prime_l_quad, self.scanned.get(
+            'length', L_GEO_QUAD), self.scanned.get('i1a_norm', I1A_NORM))
+        return (self.downstream[0] @ quad_hor @ self.upstream[0],
+                self.downstream[1] @ quad_vert @ self.upstream[1])
+
+    def get_design_matrices(self, k_prime_l_quad):
+        """
+        Same as twissfit.twiss.get_design_matrices for this lattice.
+        """
+        k_prime_l_quad = np.asarray(k_prime_l_quad, dtype=np.float64)
+        xfer_hor, xfer_vert = self.get_xfer_batch(k_prime_l_quad.ravel())
+        design = np.stack((get_twiss_matrix_batch(xfer_hor)[:, 0, :],
+                           get_twiss_matrix_batch(xfer_vert)[:, 0, :]))
+        if k_prime_l_quad.ndim > 1:
+            design = design.reshape(
+                (2,) + k_prime_l_quad.shape + (3,)).swapaxes(0, -3)
+        return design
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Plotting helpers
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import sys
+from io import BytesIO
+
+# set once pyplot has been warmed up in this process
+_warmed_up = False
+
+
+def get_pyplot():
+    """
+    Import pyplot only when plotting. If nobody has chosen a backend yet,
+    the non-interactive Agg backend is used, since all plots go to files.
+    """
+    if 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def warm_up():
+    """
+    Import pyplot and save one figure with text and a legend as PDF, once
+    per process, which loads the fonts and the PDF backend. Used before
+    profiling, so that the first plot is not charged with it. Recorded as
+    the warmup stage.
+    """
+    global _warmed_up
+    if _warmed_up:
+        return
+    from twissfit.profiling import profiler
+    with profiler.stage('warmup'):
+        plt = get_pyplot()
+        fig = plt.figure()
+        ax = fig.gca()
+        ax.plot([0, 1], [0, 1], 'kx', label='Data')
+        ax.set_xlabel('x')
+        ax.set_title('warm up')
+        ax.legend(loc='upper right')
+        ax.grid()
+        fig.savefig(BytesIO(), format='pdf')
+        plt.close(fig)
+    _warmed_up = True
+
+
+def write_pdf_report(pages, filename):
+    """
+    Write PDF pages, given as bytes, in their order into one PDF file
+    without any intermediate files.
+    """
+    from PyPDF2 import PdfFileMerger
+    from twissfit.profiling import profiler
+    with profiler.stage('report'):
+        merger = PdfFileMerger()
+        for page in pages:
+            merger.append(BytesIO(page))
+        merger.write(filename)
+        merger.close()
@@ -10,15 +10,23 @@ Xaratustrah (S. Sanjari)
 """
 import os
 import uuid
+import hashlib
 import numpy as np
-from scipy.optimize import curve_fit
 import sys
 import logging as log
 from io import BytesIO
-import matplotlib.pyplot as plt
+from twissfit.plotting import get_pyplot, warm_up as warm_up_plotting
+from twissfit.profiling import profiler
 
 
 class ProfileGridData(object):
+    # first line of the horizontal and vertical data blocks per variant
+    VARIANT_LAYOUT = {47: (5, 67), 77: (5, 83), 96: (5, None)}
+    # channel masks for the omit lists, see get_channel_mask
+    _channel_masks = {}
+    # set once the fit has been warmed up in this process, see warm_up
+    _warmed_up = False
+
     def __init__(self, filename, init_dict):
         self.filename = filename
         self.filename_base = os.path.basename(filename)
@@ -26,25 +34,106 @@ class ProfileGridData(object):
         self.x_data = np.array([])
         self.y_data = np.array([])
         self.init_dict = init_dict
+        self.fit_results = {}
+        self.file_hash = None
+
+    @staticmethod
+    def _parse_block(lines):
+        # parse numeric rows until the first non numeric line
+        nrows = 0
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] not in b'0123456789+-.':
+                break
+            nrows += 1
+        if not nrows:
+            return np.zeros((0, 2))
+        ncols = lines[0].count(b',') + 1
+        vals = np.array(b','.join(lines[:nrows]).split(b','), dtype=np.float64)
+        return vals.reshape((nrows, ncols))
+
+    @staticmethod
+    def _strip_block(block):
+        # remove surrounding white space and trailing non numeric lines
+        block = block.strip()
+        while block:
+            start = block.rfind(b'\n') + 1
+            if block[start:].lstrip()[:1] in b'0123456789+-.':
+                break
+            block = block[:start].rstrip()
+        return block
+
+    @staticmethod
+    def read_profile_file(filename, variant):
+        """
+        Read horizontal and vertical profile from a profile grid file in a
+        single pass. The data blocks are located by their section headers,
+        the skip counts of the respective variant are only used as fallback.
+        """
+        with open(filename, 'rb') as f:
+            text = f.read()
+        return ProfileGridData.parse_profile_bytes(text, variant)
+
+    @staticmethod
+    def parse_profile_bytes(text, variant):
+        """
+        Parse the content of a profile grid file, see read_profile_file.
+        For all variants, both data blocks are converted in one call. Only
+        files without section headers or with non numeric lines inside a
+        block are parsed line by line.
+        """
+        x_hdr = text.find(b'x-values')
+        y_hdr = text.find(b'y-values', x_hdr + 1)
+        if x_hdr >= 0:
+            x_block = ProfileGridData._strip_block(
+                text[text.index(b'\n', x_hdr) + 1:y_hdr if y_hdr >= 0 else len(text)])
+            y_block = b''
+            if variant != 96 and y_hdr >= 0:
+                y_block = ProfileGridData._strip_block(
+                    text[text.index(b'\n', y_hdr) + 1:])
+            ncols = x_block[:x_block.find(b'\n')].count(b',') + 1
+            try:
+                # both blocks in one conversion
+                vals = np.array(b','.join(block for block in (x_block, y_block) if block).replace(
+                    b'\n', b',').split(b','), dtype=np.float64)
+                nx = x_block.count(b'\n') + 1
+                xvals = vals[:nx * ncols].reshape((nx, ncols))
+                if variant == 96:
+                    # 96 point variant has no vertical data
+                    return xvals, np.zeros((nx, 2))
+                if y_block:
+                    return xvals, vals[nx * ncols:].reshape((-1, ncols))
+            except ValueError:
+                pass
+
+        # slow path, line by line
+        lines = text.splitlines()
+        if x_hdr >= 0:
+            x_start = text.count(b'\n', 0, x_hdr) + 1
+            y_start = text.count(b'\n', 0, y_hdr) + 1 if y_hdr >= 0 else None
+        else:
+            x_start, y_start = ProfileGridData.VARIANT_LAYOUT[variant]
 
-    def _read_data(self):
-        # 47 point variant
-        if self.init_dict['variant'] == 47:
-            xvals = np.genfromtxt(self.filename, delimiter=',',
-                                  skip_header=5, skip_footer=62)
-            yvals = np.genfromtxt(self.filename, delimiter=',', skip_header=67)
-
-        # 77 point variant
-        if self.init_dict['variant'] == 77:
-            xvals = np.genfromtxt(self.filename, delimiter=',',
-                                  skip_header=5, skip_footer=78)
-            yvals = np.genfromtxt(self.filename, delimiter=',', skip_header=83)
-
-        # 96 point varaint
-        if self.init_dict['variant'] == 96:
-            xvals = np.genfromtxt(self.filename, delimiter=',',
-                                  skip_header=5, skip_footer=1)
-            yvals = np.zeros((95, 2))
+        xvals = ProfileGridData._parse_block(lines[x_start:])
+        if variant == 96 or y_start is None:
+            # 96 point variant has no vertical data
+            yvals = np.zeros((len(xvals), 2))
+        else:
+            yvals = ProfileGridData._parse_block(lines[y_start:])
+        return xvals, yvals
+
+    def _read_bytes(self):
+        with profiler.stage('read', self.filename), open(self.filename, 'rb') as f:
+            text = f.read()
+        self.file_hash = hashlib.sha1(text).hexdigest()
+        return text
+
+    def _read_data(self, text=None):
+        if text is None:
+            text = self._read_bytes()
+        with profiler.stage('parse', self.filename):
+            xvals, yvals = ProfileGridData.parse_profile_bytes(
+                text, self.init_dict['variant'])
 
         self.x_data = xvals
         self.y_data = yvals
@@ -53,55 +142,72 @@ class ProfileGridData(object):
         log.info('Data point length before omit: {}'.format(
             np.shape(self.xy_data)[0]))
 
-        # omit the malfunctioning rows from the x_data
-        rowcnt = 0
-        rowdellist = []
-        for row in self.x_data:
-            if row[0] in self.init_dict['x_omit']:
-                rowdellist.append(rowcnt)
-            rowcnt += 1
-        self.x_data = np.delete(self.x_data, rowdellist, axis=0)
+        # omit the malfunctioning rows, masks are shared between files
+        self.x_data = self.x_data[ProfileGridData.get_channel_mask(
+            self.x_data[:, 0], self.init_dict['x_omit'])]
         log.info('Data point length after x_omit: {}'.format(
             np.shape(self.x_data)[0]))
 
-        # omit the malfunctioning rows from the x_data
-        rowcnt = 0
-        rowdellist = []
-        for row in self.y_data:
-            if row[0] in self.init_dict['y_omit']:
-                rowdellist.append(rowcnt)
-            rowcnt += 1
-        self.y_data = np.delete(self.y_data, rowdellist, axis=0)
+        self.y_data = self.y_data[ProfileGridData.get_channel_mask(
+            self.y_data[:, 0], self.init_dict['y_omit'])]
         log.info('Data point length after y_omit: {}'.format(
             np.shape(self.y_data)[0]))
 
     @staticmethod
-    def create_sim_data():
-        x = np.arange(-45, 46.5, 1.5)
+    def get_channel_mask(positions, omit):
+        """
+        Boolean mask of the channels to keep. The mask is calculated once
+        per channel layout and omit list and then reused for every file.
+        """
+        key = (tuple(omit), len(positions))
+        cached = ProfileGridData._channel_masks.get(key)
+        if cached is not None and np.array_equal(cached[0], positions):
+            return cached[1]
+        mask = ~np.isin(positions, omit)
+        positions = positions.copy()
+        ProfileGridData._channel_masks[key] = (positions, mask)
+        return mask
+
+    @staticmethod
+    def get_sim_positions(npoints=None):
+        if npoints is None:
+            return np.arange(-45, 46.5, 1.5)
+        return np.linspace(-45, 45, npoints)
+
+    @staticmethod
+    def create_sim_data(npoints=None):
+        x = ProfileGridData.get_sim_positions(npoints)
         amp = np.random.randint(800, 1800)
         mu = np.random.randint(-20, 20)
         sigma = np.random.randint(2, 10)
         popt = [0, 0, amp, mu, sigma]
         vals = ProfileGridData.fit_function(x, *popt)
-        plt.plot(x, vals, 'ro', label='Fit')
         # np.vstack((x, vals)).T
         return x, vals, amp, mu, sigma
 
     @staticmethod
-    def write_sim_data():
-        filename = str(uuid.uuid1()) + '.csv'
-        xh, valsh, amph, muh, sigmah = ProfileGridData.create_sim_data()
-        xv, valsv, ampv, muv, sigmav = ProfileGridData.create_sim_data()
+    def write_sim_data(npoints=None, directory=''):
+        filename = os.path.join(directory, str(uuid.uuid1()) + '.csv')
+        xh, valsh, amph, muh, sigmah = ProfileGridData.create_sim_data(npoints)
+        xv, valsv, ampv, muv, sigmav = ProfileGridData.create_sim_data(npoints)
         with open(filename, 'w') as file:
-            file.write('device:\nSIMULATION\ngain:\nSIMULATION\n')
-            file.write(
-                'x-values: (Amp {} Mu {} Sigma {})\n'.format(amph, muh, sigmah))
-            for i in range(len(xh)):
-                file.write('{}, {}\n'.format(xh[i], valsh[i]))
-            file.write(
-                'y-values: (Amp {} Mu {} Sigma {})\n'.format(ampv, muv, sigmav))
-            for i in range(len(xv)):
-                file.write('{}, {}\n'.format(xv[i], valsv[i]))
+            file.write(ProfileGridData.format_profile_file(
+                xh, valsh, 'Amp {} Mu {} Sigma {}'.format(amph, muh, sigmah),
+                xv, valsv, 'Amp {} Mu {} Sigma {}'.format(ampv, muv, sigmav)))
+        return filename
+
+    @staticmethod
+    def format_profile_file(xh, valsh, info_hor, xv, valsv, info_vert):
+        """
+        Content of a simulated profile grid file. Each block is formatted
+        with a single format call instead of one per line.
+        """
+        block = '{}, {}\n'
+        return ''.join(('device:\nSIMULATION\ngain:\nSIMULATION\n',
+                        'x-values: ({})\n'.format(info_hor),
+                        (block * len(xh)).format(*np.column_stack((xh, valsh)).ravel().tolist()),
+                        'y-values: ({})\n'.format(info_vert),
+                        (block * len(xv)).format(*np.column_stack((xv, valsv)).ravel().tolist())))
 
     @staticmethod
     def fit_function(x, *p):
@@ -111,17 +217,56 @@ class ProfileGridData(object):
         return p[0] + p[1] * x + p[2] * np.exp(-(x - p[3]) ** 2 / (2. * p[4] ** 2))
 
     @staticmethod
-    def fit_and_plot(x_data, y_data, fit_params, title='', filename=''):
-
-        # x and y are the variables for the fitter
-        x = x_data
-        x_for_plotting = np.linspace(x_data.min(), x_data.max(), 400)
-        y = y_data
+    def fit_jacobian(x, *p):
+        """
+        Analytic Jacobian of the fit function with respect to the parameters
+        """
+        gauss = np.exp(-(x - p[3]) ** 2 / (2. * p[4] ** 2))
+        jac = np.empty((len(x), 5))
+        jac[:, 0] = 1
+        jac[:, 1] = x
+        jac[:, 2] = gauss
+        jac[:, 3] = p[2] * gauss * (x - p[3]) / p[4] ** 2
+        jac[:, 4] = p[2] * gauss * (x - p[3]) ** 2 / p[4] ** 3
+        return jac
 
-        # take values from init JSON or estimate default values
-        # params are like: [offset, slope, amp, mean, sigma, cut_range]
+    @staticmethod
+    def estimate_params(x, y):
+        """
+        Closed form estimate of [offset, slope, amp, mean, sigma] from a
+        parabola fitted to the logarithm of the peak region. Falls back to
+        the moments of the distribution if that fails.
+        """
+        offset = np.min(y)
+        yy = y - offset
+        peak = yy > 0.2 * yy.max()
+        if np.count_nonzero(peak) >= 3:
+            c2, c1, c0 = np.polyfit(x[peak], np.log(yy[peak]), 2)
+            if c2 < 0:
+                mean = -c1 / (2 * c2)
+                sigma = np.sqrt(-1 / (2 * c2))
+                amp = np.exp(c0 - c1 ** 2 / (4 * c2))
+                return [offset, 0, amp, mean, sigma]
+        # moments
+        weights = yy / yy.sum()
+        mean = np.sum(weights * x)
+        sigma = np.sqrt(np.sum(weights * (x - mean) ** 2))
+        return [offset, 0, yy.max(), mean, sigma]
 
+    @staticmethod
+    def get_initial_params(x, y, fit_params, estimate=False):
+        """
+        Take values from init JSON or estimate default values.
+        Params are like: [offset, slope, amp, mean, sigma, cut_range]
+        With estimate, the defaults come from estimate_params.
+        """
         mean_idx = y.argmax()
+        if estimate:
+            defaults = ProfileGridData.estimate_params(x, y)
+            p = [fit_params[i] if fit_params[i] else defaults[i]
+                 for i in range(5)]
+            cut_range = fit_params[5] if fit_params[5] else 3 * p[4]
+            return p, cut_range
 
         if not fit_params[0]:
             offset = y[mean_idx - 5]
@@ -153,19 +298,137 @@ class ProfileGridData(object):
         else:
             cut_range = fit_params[5]
 
-        p = [offset, slope, amp, mean, sigma]
+        return [offset, slope, amp, mean, sigma], cut_range
+
+    @staticmethod
+    def fit(x_data, y_data, fit_params, estimate=False):
+        """
+        Fit only, without any plotting. Returns the fit parameters, their
+        covariance, the area and the limits of the fitting region.
+        """
+        # x and y are the variables for the fitter
+        x = x_data
+        y = y_data
+
+        p, cut_range = ProfileGridData.get_initial_params(
+            x, y, fit_params, estimate=estimate)
+        mean = p[3]
         # defining the fitting region
-        data_cut = (x > mean - cut_range) & (x < mean + cut_range)
-        x_for_plotting_data_cut = (
-            x_for_plotting > mean - cut_range) & (x_for_plotting < mean + cut_range)
+        fit_range = (mean - cut_range, mean + cut_range)
+        data_cut = (x > fit_range[0]) & (x < fit_range[1])
 
         # fit
+        from scipy.optimize import curve_fit
         popt, pcov = curve_fit(ProfileGridData.fit_function,
-                               x[data_cut], y[data_cut], p0=p)
+                               x[data_cut], y[data_cut], p0=p,
+                               jac=ProfileGridData.fit_jacobian)
+
+        area = sum(ProfileGridData.fit_function(x, *popt))
+        return popt, pcov, area, fit_range
+
+    @staticmethod
+    def _fit_function_and_jacobian_batch(x, p):
+        # fit function and its Jacobian for rows of parameters p of shape (M, 5)
+        p = p[:, :, np.newaxis]
+        dx = x - p[:, 3]
+        gauss = np.exp(-dx ** 2 / (2. * p[:, 4] ** 2))
+        vals = p[:, 0] + p[:, 1] * x + p[:, 2] * gauss
+        jac = np.empty(vals.shape + (5,))
+        jac[..., 0] = 1
+        jac[..., 1] = x
+        jac[..., 2] = gauss
+        jac[..., 3] = p[:, 2] * gauss * dx / p[:, 4] ** 2
+        jac[..., 4] = p[:, 2] * gauss * dx ** 2 / p[:, 4] ** 3
+        return vals, jac
+
+    @staticmethod
+    def fit_batch(x_data, y_data, fit_params, valid=None, estimate=False, max_iter=200, tol=1e-10):
+        """
+        Fit M profiles at once with a vectorized Levenberg-Marquardt solver.
+
+        x_data has shape (channels,) or (M, channels), y_data (M, channels).
+        valid is an optional boolean mask of usable channels, e.g. from
+        get_channel_mask, with the same shape as x_data or y_data. The start
+        values and fitting region of each row are chosen as in fit.
+
+        Returns popt (M, 5), pcov (M, 5, 5) and area (M,).
+        """
+        y = np.atleast_2d(np.asarray(y_data, dtype=np.float64))
+        x = np.broadcast_to(np.asarray(x_data, dtype=np.float64), y.shape)
+        nrows = len(y)
+        if valid is None:
+            valid = np.ones(y.shape, dtype=bool)
+        valid = np.broadcast_to(valid, y.shape)
+
+        p = np.empty((nrows, 5))
+        cut = np.empty(y.shape, dtype=bool)
+        for i in range(nrows):
+            xi = x[i][valid[i]]
+            p[i], cut_range = ProfileGridData.get_initial_params(
+                xi, y[i][valid[i]], fit_params, estimate=estimate)
+            cut[i] = valid[i] & (x[i] > p[i, 3] - cut_range) & (
+                x[i] < p[i, 3] + cut_range)
+        weights = cut.astype(np.float64)
+
+        vals, jac = ProfileGridData._fit_function_and_jacobian_batch(x, p)
+        res = (y - vals) * weights
+        cost = np.sum(res ** 2, axis=1)
+        lam = np.full(nrows, 1.)
+        active = np.ones(nrows, dtype=bool)
+        eye = np.eye(5)
+
+        for _ in range(max_iter):
+            if not active.any():
+                break
+            idx = np.flatnonzero(active)
+            jw = jac[idx] * weights[idx, :, np.newaxis]
+            jtj = np.swapaxes(jw, 1, 2) @ jw
+            grad = (np.swapaxes(jw, 1, 2) @ res[idx, :, np.newaxis])[..., 0]
+            damped = jtj + lam[idx, np.newaxis, np.newaxis] * \
+                jtj * eye + 1e-12 * eye
+            step = np.linalg.solve(damped, grad[..., np.newaxis])[..., 0]
+            p_new = p[idx] + step
+            vals_new, jac_new = ProfileGridData._fit_function_and_jacobian_batch(
+                x[idx], p_new)
+            res_new = (y[idx] - vals_new) * weights[idx]
+            cost_new = np.sum(res_new ** 2, axis=1)
+
+            better = np.isfinite(cost_new) & (cost_new <= cost[idx])
+            acc = idx[better]
+            converged = np.zeros(len(idx), dtype=bool)
+            converged[better] = (cost[acc] - cost_new[better]
+                                 ) <= tol * np.maximum(cost[acc], 1e-300)
+            p[acc] = p_new[better]
+            jac[acc] = jac_new[better]
+            res[acc] = res_new[better]
+            cost[acc] = cost_new[better]
+            lam[acc] /= 10
+            lam[idx[~better]] *= 10
+            converged |= lam[idx] > 1e10
+            active[idx[converged]] = False
+
+        # covariance scaled by the residual variance like curve_fit does
+        jw = jac * weights[..., np.newaxis]
+        jtj = np.swapaxes(jw, 1, 2) @ jw
+        dof = np.maximum(cut.sum(axis=1) - 5, 1)
+        pcov = np.linalg.pinv(jtj) * (cost / dof)[:, np.newaxis, np.newaxis]
+
+        all_vals, _ = ProfileGridData._fit_function_and_jacobian_batch(x, p)
+        area = np.sum(all_vals * valid, axis=1)
+        return p, pcov, area
+
+    @staticmethod
+    def plot_fit(x_data, y_data, popt, area, fit_range, title='', filename=''):
+        plt = get_pyplot()
+
+        x = x_data
+        y = y_data
+        x_for_plotting = np.linspace(x_data.min(), x_data.max(), 400)
+        x_for_plotting_data_cut = (
+            x_for_plotting > fit_range[0]) & (x_for_plotting < fit_range[1])
         mean = popt[3]
         sigma = np.abs(popt[4])  # make sure sigma is positive
 
-        area = sum(ProfileGridData.fit_function(x, *popt))
         # plot with original data
         fig = plt.figure()
         ax = fig.gca()
@@ -183,35 +446,125 @@ class ProfileGridData(object):
         for label in legend.get_texts():
             label.set_fontsize('small')
 
-        plt.grid()
+        ax.grid()
+        # filename can also be a file like object
         if filename:
-            plt.savefig(filename)
-        return popt, area
+            fig.savefig(filename, format='pdf')
+        plt.close(fig)
 
-    def process_horiz_and_vert(self, verbose=False):
-        self._read_data()
+    @staticmethod
+    def fit_and_plot(x_data, y_data, fit_params, title='', filename=''):
+        popt, pcov, area, fit_range = ProfileGridData.fit(
+            x_data, y_data, fit_params)
+        ProfileGridData.plot_fit(x_data, y_data, popt, area, fit_range,
+                                 title=title, filename=filename)
+        return popt, area
 
-        # horizontal direction
-        x_pos = self.x_data[:, 0]
-        hor_grid = self.x_data[:, 1]
-        plot_filename_hor = '{}_Horizontal.pdf'.format(self.filename_wo_ext)
-        popt, area = ProfileGridData.fit_and_plot(
-            x_pos, hor_grid, self.init_dict['x_fit_params'], title='{}_Horizontal'.format(self.filename_base), filename=plot_filename_hor)
+    @staticmethod
+    def warm_up(plot=True):
+        """
+        Import scipy and fit one simulated profile, and for plots also warm
+        up matplotlib, once per process. Done before profiling the first
+        file, so that it is not charged with the import and warm-up time.
+        Recorded as the warmup stage without a file.
+        """
+        if not ProfileGridData._warmed_up:
+            with profiler.stage('warmup'):
+                x, y, _, _, _ = ProfileGridData.create_sim_data()
+                ProfileGridData.fit(x, y, [None] * 6)
+            ProfileGridData._warmed_up = True
+        if plot:
+            warm_up_plotting()
+
+    def _fit_plane(self, data, fit_params, direction):
+        pos = data[:, 0]
+        grid = data[:, 1]
+        with profiler.stage('fit', self.filename):
+            popt, pcov, area, fit_range = ProfileGridData.fit(
+                pos, grid, fit_params, estimate=self.init_dict.get('estimate', False))
+        self.fit_results[direction] = (pos, grid, popt, pcov, area, fit_range)
         log.info('File Name | Offset | Slope | Amplitude | Mean | Sigma')
         log.info('{} | {} | {}'.format(self.filename_base,
                                        ' | '.join(map(str, popt)), area))
+
+    def render_plots(self, directions=('Horizontal', 'Vertical'), in_memory=False):
+        """
+        Render the plots of already fitted data, e.g. after a fit without
+        plots. Returns the names of the PDF files, or with in_memory the
+        content of the PDF pages as bytes, without writing any files.
+        """
+        plots = []
+        for direction in directions:
+            pos, grid, popt, pcov, area, fit_range = self.fit_results[direction]
+            if in_memory:
+                output = BytesIO()
+            else:
+                output = '{}_{}.pdf'.format(self.filename_wo_ext, direction)
+            with profiler.stage('plot', self.filename):
+                ProfileGridData.plot_fit(pos, grid, popt, area, fit_range, title='{}_{}'.format(
+                    self.filename_base, direction), filename=output)
+            plots.append(output.getvalue() if in_memory else output)
+        return plots
+
+    def get_fit_summary(self):
+        """
+        Fit parameters, covariances and areas of both planes as arrays of
+        shape (2, 5), (2, 5, 5) and (2,), horizontal plane first.
+        """
+        popt = np.array([self.fit_results[d][2]
+                         for d in ('Horizontal', 'Vertical')])
+        pcov = np.array([self.fit_results[d][3]
+                         for d in ('Horizontal', 'Vertical')])
+        area = np.array([self.fit_results[d][4]
+                         for d in ('Horizontal', 'Vertical')])
+        return popt, pcov, area
+
+    def process_horiz_and_vert(self, verbose=False, plot=True, cache=None, text=None):
+        """
+        Fit both planes. If a FitCache is given, stored results for the same
+        file content and settings are used instead of fitting again. The
+        content of the file can be given as bytes in text, then the file is
+        not read.
+        """
+        if profiler.enabled:
+            ProfileGridData.warm_up(plot=plot)
+        if text is None:
+            text = self._read_bytes()
+        else:
+            self.file_hash = hashlib.sha1(text).hexdigest()
+        cached = None
+        if cache is not None:
+            from twissfit.fitcache import get_cache_key
+            cache_key = get_cache_key(self.file_hash, self.init_dict)
+            with profiler.stage('cache', self.filename):
+                cached = cache.get(cache_key)
+
+        if cached is not None:
+            log.info('Using cached fit results for {}'.format(
+                self.filename_base))
+            self.fit_results = cached
+            self.x_data = np.column_stack(cached['Horizontal'][:2])
+            self.y_data = np.column_stack(cached['Vertical'][:2])
+        else:
+            self._read_data(text)
+            # horizontal direction
+            self._fit_plane(
+                self.x_data, self.init_dict['x_fit_params'], 'Horizontal')
+            # vertical direction
+            self._fit_plane(
+                self.y_data, self.init_dict['y_fit_params'], 'Vertical')
+            if cache is not None:
+                cache.put(cache_key, self.fit_results)
+
+        popt = self.fit_results['Horizontal'][2]
         mean_x = popt[3]
         sigma_x = np.abs(popt[4])  # make sure sigma is positive
-
-        # vertical direction
-        y_pos = self.y_data[:, 0]
-        ver_grid = self.y_data[:, 1]
-        plot_filename_vert = '{}_Vertical.pdf'.format(self.filename_wo_ext)
-        popt, area = ProfileGridData.fit_and_plot(
-            y_pos, ver_grid, self.init_dict['y_fit_params'], title='{}_Vertical'.format(self.filename_base), filename=plot_filename_vert)
-        log.info('File Name | Offset | Slope | Amplitude | Mean | Sigma')
-        log.info('{} | {} | {}'.format(self.filename_base,
-                                       ' | '.join(map(str, popt)), area))
+        popt = self.fit_results['Vertical'][2]
         mean_y = popt[3]
         sigma_y = np.abs(popt[4])  # make sure sigma is positive
+
+        # without plots the file names are None, see render_plots
+        plot_filename_hor = plot_filename_vert = None
+        if plot:
+            plot_filename_hor, plot_filename_vert = self.render_plots()
         return mean_x, mean_y, sigma_x, sigma_y, plot_filename_hor, plot_filename_vert
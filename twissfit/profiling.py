@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and memory instrumentation of the processing stages
+
+Library code marks its stages with the stage context manager of the
+global profiler. Nothing is recorded unless the profiler is enabled, e.g.
+by the --profile switch of the command line tool:
+
+    from twissfit.profiling import profiler
+    profiler.enable(memory=True)
+    ...
+    profiler.write_summary('profile.json')
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import json
+import time
+import tracemalloc
+import numpy as np
+from contextlib import contextmanager
+
+# number of slowest files in the summary
+NSLOWEST = 10
+
+
+class Profiler(object):
+    """
+    Records wall time and optionally peak memory of each call of a stage,
+    together with the file it belongs to, if any.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.records = []
+        self._peaks = []
+        self._start = None
+
+    def enable(self, memory=False):
+        self.enabled = True
+        self.memory = memory
+        self._start = time.perf_counter()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def reset(self):
+        self.records = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, item=None):
+        if not self.enabled:
+            yield
+            return
+        if self.memory:
+            # peak of the enclosing stage so far, before it is reset
+            if self._peaks:
+                self._peaks[-1] = max(
+                    self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = None
+            if self.memory:
+                peak = max(self._peaks.pop(),
+                           tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+            self.records.append((name, item, seconds, peak))
+
+    def summary(self):
+        """
+        Calls, total, median and maximum time and peak memory per stage,
+        the time per stage of every file and the slowest files compared to
+        the median file.
+        """
+        stages = {}
+        files = {}
+        for name, item, seconds, peak in self.records:
+            stage = stages.setdefault(name, {'seconds': [], 'peak': 0})
+            stage['seconds'].append(seconds)
+            if peak is not None:
+                stage['peak'] = max(stage['peak'], peak)
+            if item is not None:
+                file_stages = files.setdefault(item, {})
+                file_stages[name] = file_stages.get(name, 0) + seconds
+
+        result = {'wall_s': time.perf_counter() - self._start if self._start is not None else None,
+                  'stages': {},
+                  'files': files}
+        for name, stage in stages.items():
+            seconds = np.array(stage['seconds'])
+            result['stages'][name] = {'calls': len(seconds),
+                                      'total_s': seconds.sum(),
+                                      'median_s': np.median(seconds),
+                                      'max_s': seconds.max()}
+            if self.memory:
+                result['stages'][name]['peak_memory_mb'] = stage['peak'] / 2**20
+
+        if files:
+            totals = {item: sum(file_stages.values())
+                      for item, file_stages in files.items()}
+            median = np.median(list(totals.values()))
+            slowest = sorted(totals, key=totals.get, reverse=True)[:NSLOWEST]
+            result['slowest_files'] = [{'file': item,
+                                        'total_s': totals[item],
+                                        'ratio_to_median': totals[item] / median if median > 0 else None}
+                                       for item in slowest]
+        return result
+
+    def write_summary(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=1, default=float)
+
+
+profiler = Profiler()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Binary columnar store for fit and Twiss results
+
+A store is a directory with one .npy file per column and an index.json
+with the file names, content hashes and Twiss results. Columns can be
+loaded memory mapped, so reading a store does not copy the data. A store
+and a profile archive cannot share a directory.
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import os
+import json
+import numpy as np
+
+# column name: shape of one row
+COLUMNS = {'k_prime_l_quad': (),
+           'popt': (2, 5),
+           'pcov': (2, 5, 5),
+           'area': (2,)}
+
+INDEX_FILENAME = 'index.json'
+STORE_VERSION = 1
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+
+def check_store_path(path):
+    """
+    Raise a ValueError if the directory holds a profile archive, which
+    would be overwritten by the store.
+    """
+    from twissfit.archive import is_archive
+    if is_archive(path):
+        raise ValueError(
+            '{} holds a profile archive, use another directory for the result store.'.format(path))
+
+
+def save_store(path, filenames, file_hashes, k_prime_l_quad, popt, pcov, area, twiss=None):
+    """
+    Write a result store. popt, pcov and area hold both planes per file,
+    horizontal first, as returned by ProfileGridData.get_fit_summary.
+    twiss is an optional dict of Twiss results, e.g. beta_x, eps_y...
+    """
+    check_store_path(path)
+    os.makedirs(path, exist_ok=True)
+    nrows = len(filenames)
+    columns = {'k_prime_l_quad': k_prime_l_quad,
+               'popt': popt, 'pcov': pcov, 'area': area}
+    for name, shape in COLUMNS.items():
+        data = np.asarray(columns[name], dtype=np.float64)
+        if data.shape != (nrows,) + shape:
+            raise ValueError('Column {} has shape {}, expected {}.'.format(
+                name, data.shape, (nrows,) + shape))
+        np.save(os.path.join(path, name + '.npy'), data)
+    write_index(path, filenames, file_hashes, twiss)
+
+
+def create_store(path, nrows):
+    """
+    Create the columns of a result store with nrows rows as writable memory
+    maps, so that results can be filled in chunk by chunk. The store is
+    complete once write_index has been called.
+    """
+    check_store_path(path)
+    os.makedirs(path, exist_ok=True)
+    return {name: np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                            dtype=np.float64, shape=(nrows,) + shape)
+            for name, shape in COLUMNS.items()}
+
+
+def write_index(path, filenames, file_hashes, twiss=None):
+    index = {'version': STORE_VERSION,
+             'filenames': list(filenames),
+             'file_hashes': list(file_hashes),
+             'twiss': {key: float(val) for key, val in (twiss or {}).items()}}
+    with open(os.path.join(path, INDEX_FILENAME), 'w') as f:
+        json.dump(index, f, indent=1)
+
+
+def load_store(path, mmap=True):
+    """
+    Load a result store. Returns the index dictionary and a dictionary of
+    columns, which are read only memory maps unless mmap is False.
+    """
+    with open(os.path.join(path, INDEX_FILENAME), 'r') as f:
+        index = json.load(f)
+    mmap_mode = 'r' if mmap else None
+    columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+               for name in COLUMNS}
+    return index, columns
+
+
+def get_result_matrix(columns):
+    """
+    Result matrix with K'L, sigma_x and sigma_y as used by
+    solve_equation_system.
+    """
+    return np.column_stack((columns['k_prime_l_quad'],
+                            np.abs(columns['popt'][:, 0, 4]),
+                            np.abs(columns['popt'][:, 1, 4])))
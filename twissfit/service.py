@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Long lived fit service
+
+Keeps the fitting and solving code loaded and answers requests on a local
+Unix socket or a TCP port on localhost. Requests and responses are JSON
+objects, one per line, several requests can be sent over one connection
+and many clients are served at the same time. The fits run on a bounded
+pool of worker processes:
+
+    python -m twissfit.service --socket /tmp/twissfit.sock -j 4 -i init.json
+
+Requests:
+
+    {"command": "ping"}
+    {"command": "fit", "path": "file.csv"}
+    {"command": "fit", "data": "<content of a profile grid file>"}
+    {"command": "solve", "k_prime_l_quad": [...], "sigma_x": [...], "sigma_y": [...]}
+    {"command": "process", "files": [{"path": "file.csv", "k_prime_l_quad": 0.5}, ...]}
+
+Each response has "ok" and either the results or an "error" message.
+Results that are not finite, e.g. of an unphysical solution, are null.
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import os
+import sys
+import json
+import math
+import signal
+import socket
+import asyncio
+import argparse
+import logging as log
+from twissfit.version import __version__
+
+# maximum length of one request line, enough for profile data
+LINE_LIMIT = 2**24
+DEFAULT_INIT_DICT = {"x_omit": [],
+                     "y_omit": [],
+                     "x_fit_params": [None, None, None, None, None, None],
+                     "y_fit_params": [None, None, None, None, None, None],
+                     "variant": 47}
+
+# fit cache of each worker process, see _init_worker
+_worker_cache = None
+
+
+def _init_worker(use_cache):
+    global _worker_cache
+    # import everything once, not with the first request
+    import scipy.optimize
+    from twissfit.profilegriddata import ProfileGridData
+    if use_cache:
+        from twissfit.fitcache import FitCache
+        _worker_cache = FitCache()
+
+
+def fit_profile(init_dict, path=None, data=None):
+    """
+    Fit both planes of a profile grid file, given by its path or content.
+    Returns a dictionary which can be sent as JSON.
+    """
+    from twissfit.profilegriddata import ProfileGridData
+    if data is not None:
+        grid_data = ProfileGridData(path or '<data>', init_dict)
+        result = grid_data.process_horiz_and_vert(
+            plot=False, cache=_worker_cache, text=data.encode())
+    elif path is not None:
+        grid_data = ProfileGridData(path, init_dict)
+        result = grid_data.process_horiz_and_vert(
+            plot=False, cache=_worker_cache)
+    else:
+        raise ValueError('Either path or data is needed.')
+    mean_x, mean_y, sigma_x, sigma_y, _, _ = result
+    popt, pcov, area = grid_data.get_fit_summary()
+    return {'file_hash': grid_data.file_hash,
+            'mean_x': float(mean_x), 'mean_y': float(mean_y),
+            'sigma_x': float(sigma_x), 'sigma_y': float(sigma_y),
+            'popt': popt.tolist(), 'pcov': pcov.tolist(), 'area': area.tolist()}
+
+
+def to_json(response):
+    """
+    Encode a response, with null for NaN and infinity, which are not valid
+    JSON.
+    """
+    def finite(obj):
+        if isinstance(obj, float):
+            return obj if math.isfinite(obj) else None
+        if isinstance(obj, dict):
+            return {key: finite(val) for key, val in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return [finite(val) for val in obj]
+        return obj
+    return json.dumps(finite(response), allow_nan=False).encode() + b'\n'
+
+
+def solve(k_prime_l_quad, sigma_x, sigma_y, lattice=None):
+    import numpy as np
+    from twissfit.twiss import solve_equation_system
+    result_matrix = np.column_stack((k_prime_l_quad, sigma_x, sigma_y)).astype(np.float64)
+    if len(result_matrix) < 3:
+        raise ValueError('At least 3 measurements are needed.')
+    twiss = solve_equation_system(result_matrix, lattice=lattice)
+    return dict(zip(('beta_x', 'alpha_x', 'eps_x', 'beta_y', 'alpha_y', 'eps_y'),
+                    map(float, twiss)))
+
+
+class FitService(object):
+    def __init__(self, init_dict, lattice=None, jobs=1, max_pending=None, use_cache=True):
+        from concurrent.futures import ProcessPoolExecutor
+        self.init_dict = init_dict
+        self.lattice = lattice
+        self.executor = ProcessPoolExecutor(
+            max_workers=jobs, initializer=_init_worker, initargs=(use_cache,))
+        # limits the fits waiting for a worker, further requests wait here
+        self.pending = asyncio.Semaphore(max_pending or 4 * jobs)
+        self.server = None
+        self.clients = set()
+
+    async def fit(self, message):
+        init_dict = message.get('init', self.init_dict)
+        async with self.pending:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, fit_profile, init_dict, message.get('path'), message.get('data'))
+
+    async def handle_request(self, message):
+        command = message.get('command')
+        if command == 'ping':
+            return {'version': __version__}
+        if command == 'fit':
+            return await self.fit(message)
+        if command == 'solve':
+            return solve(message['k_prime_l_quad'], message['sigma_x'],
+                         message['sigma_y'], lattice=self.lattice)
+        if command == 'process':
+            files = message['files']
+            fits = await asyncio.gather(*(self.fit(dict(file, init=message.get('init', self.init_dict)))
+                                          for file in files))
+            twiss = solve([file['k_prime_l_quad'] for file in files],
+                          [fit['sigma_x'] for fit in fits],
+                          [fit['sigma_y'] for fit in fits], lattice=self.lattice)
+            return {'fits': fits, 'twiss': twiss}
+        raise ValueError('Unknown command {}.'.format(command))
+
+    async def handle_client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # line too long, the rest of the stream is unusable
+                    writer.write(
+                        to_json({'ok': False, 'error': 'Request too long.'}))
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    response = await self.handle_request(json.loads(line))
+                    response['ok'] = True
+                except Exception as e:
+                    log.info('Request failed: {}'.format(e))
+                    response = {'ok': False, 'error': '{}: {}'.format(
+                        type(e).__name__, e)}
+                writer.write(to_json(response))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=None):
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_client, path=socket_path, limit=LINE_LIMIT)
+            log.info('Listening on {}'.format(socket_path))
+        else:
+            server = await asyncio.start_server(self.handle_client, host=host, port=port, limit=LINE_LIMIT)
+            log.info('Listening on {}:{}'.format(host, port))
+        self.server = server
+        # returns after stop
+        await server.wait_closed()
+
+    def stop(self):
+        """
+        Stop accepting connections and close the open ones, so that serve
+        returns.
+        """
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def send_request(message, socket_path=None, host='127.0.0.1', port=None, timeout=None):
+    """
+    Send one request to a running service and return the response.
+    """
+    if socket_path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = socket_path
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        address = (host, port)
+    sock.settimeout(timeout)
+    with sock:
+        sock.connect(address)
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve fit and Twiss requests on a local socket.')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Path of the Unix socket.')
+    parser.add_argument('--port', type=int, default=None,
+                        help='TCP port on localhost, if no socket is given.')
+    parser.add_argument('-i', '--init', type=str, default=None,
+                        help='Name of the initialiser JSON file.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes for fitting, 0 uses all cores.')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='Number of fits waiting for a worker, default 4 per worker.')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='Do not use the on-disk fit cache.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Increase output verbosity')
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.basicConfig(level=log.INFO)
+
+    if args.socket is None and args.port is None:
+        print('Please give a socket path or a port.')
+        sys.exit()
+
+    init_dict = DEFAULT_INIT_DICT
+    lattice = None
+    if args.init:
+        with open(args.init, 'r') as f:
+            init_dict = json.load(f)
+        from twissfit.lattice import Lattice
+        lattice = Lattice.from_init_dict(init_dict, args.init)
+
+    async def run():
+        service = FitService(init_dict, lattice=lattice, jobs=args.jobs or os.cpu_count(),
+                             max_pending=args.max_pending, use_cache=not args.no_cache)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, service.stop)
+        try:
+            await service.serve(args.socket, port=args.port)
+        finally:
+            service.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic measurement campaigns with known Twiss parameters
+
+The given Twiss parameters at the reference plane are propagated through
+the beam line for every K'L, and noisy profiles with the resulting beam
+sizes are written either as profile grid files or as an archive, see
+twissfit.archive. A manifest.json stores the ground truth, so that the
+results of the pipeline can be checked against it:
+
+    python -m twissfit.simulation -o campaign --twiss 12 9 20 14 -1 4 --k-prime-l 0.3 1.5 1000
+
+2019
+
+Xaratustrah (S. Sanjari)
+
+"""
+import os
+import sys
+import json
+import uuid
+import argparse
+import logging as log
+import numpy as np
+from twissfit.profilegriddata import ProfileGridData
+from twissfit.twiss import L_DRIFT, get_xfer_batch, transform_batch, get_sigma
+
+MANIFEST_FILENAME = 'manifest.json'
+CHUNK_SIZE = 1000
+
+
+def get_true_sigmas(k_prime_l_quad, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y, lattice=None):
+    """
+    Beam sizes at the profile grid of shape (N, 2), horizontal first, for
+    the Twiss parameters at the reference plane.
+    """
+    k_prime_l_quad = np.atleast_1d(np.asarray(k_prime_l_quad, dtype=np.float64))
+    if lattice is None:
+        xfer_hor, xfer_vert = get_xfer_batch(k_prime_l_quad, L_DRIFT)
+    else:
+        xfer_hor, xfer_vert = lattice.get_xfer_batch(k_prime_l_quad)
+    beta1_x, _, _ = transform_batch(beta_x, alpha_x, xfer_hor)
+    beta1_y, _, _ = transform_batch(beta_y, alpha_y, xfer_vert)
+    return np.column_stack((get_sigma(beta1_x, eps_x), get_sigma(beta1_y, eps_y)))
+
+
+def create_profiles(positions, sigmas, rng, noise=0.01, amp_range=(800, 1800), mean_range=(-5, 5)):
+    """
+    Noisy profiles of shape (N, 2, channels) for beam sizes of shape (N, 2).
+    Amplitudes and means are drawn at random, the noise is Gaussian with a
+    standard deviation relative to the amplitude. Returns the profiles and
+    the parameters [offset, slope, amp, mean, sigma] of shape (N, 2, 5).
+    """
+    params = np.zeros(sigmas.shape + (5,))
+    params[..., 2] = rng.uniform(*amp_range, size=sigmas.shape)
+    params[..., 3] = rng.uniform(*mean_range, size=sigmas.shape)
+    params[..., 4] = sigmas
+    profiles = params[..., 2, np.newaxis] * np.exp(
+        -(positions - params[..., 3, np.newaxis])**2 / (2 * sigmas[..., np.newaxis]**2))
+    profiles += rng.normal(size=profiles.shape) * \
+        noise * params[..., 2, np.newaxis]
+    return profiles, params
+
+
+def quantize_k_prime_l(k_prime_l_quad):
+    """
+    K'L rounded to the resolution of the file names, i.e. the values read
+    back by the -c switch from the first 4 characters. Values that cannot
+    be written in 4 characters raise a ValueError.
+    """
+    k_prime_l_quad = np.round(k_prime_l_quad, 2)
+    invalid = [kl for kl in k_prime_l_quad.tolist() if len('{:.2f}'.format(kl)) != 4]
+    if invalid:
+        raise ValueError('K\'L values {} cannot be stored in file names, use an archive.'.format(
+            invalid[:5]))
+    return k_prime_l_quad
+
+
+def get_filenames(k_prime_l_quad):
+    # first 4 characters are the K'L as expected by the -c switch
+    return ['{:.2f}_{}.csv'.format(kl, uuid.uuid4()) for kl in k_prime_l_quad]
+
+
+def _write_chunk(directory, filenames, positions, sigmas, seed, noise, archive=None, start=0):
+    """
+    Create the profiles of one chunk and write them as files or into the
+    rows of an archive starting at start. Returns the profile parameters.
+    """
+    rng = np.random.default_rng(seed)
+    profiles, params = create_profiles(positions, sigmas, rng, noise)
+    if archive is not None:
+        archive_profiles = np.load(os.path.join(archive, 'profiles.npy'), mmap_mode='r+')
+        archive_profiles[start:start + len(profiles)] = profiles
+        archive_profiles.flush()
+        return params
+    for filename, profile, param in zip(filenames, profiles, params):
+        with open(os.path.join(directory, filename), 'w') as f:
+            f.write(ProfileGridData.format_profile_file(
+                positions, profile[0], 'Amp {} Mu {} Sigma {}'.format(*param[0, 2:]),
+                positions, profile[1], 'Amp {} Mu {} Sigma {}'.format(*param[1, 2:])))
+    return params
+
+
+def write_campaign(directory, k_prime_l_quad, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y, npoints=None,
+                   noise=0.01, seed=None, jobs=1, archive=False, variant=47, lattice=None, chunk_size=CHUNK_SIZE):
+    """
+    Write a synthetic campaign into directory, one profile grid file per
+    K'L or with archive a profile archive of the given variant. Chunks are
+    written on several processes with jobs > 1, each with its own random
+    stream, so the result does not depend on the number of processes.
+    For files, K'L is rounded to the 2 decimals of the file names first, so
+    that the simulated values are those the pipeline reads back. Returns
+    the manifest with the ground truth.
+    """
+    k_prime_l_quad = np.atleast_1d(np.asarray(k_prime_l_quad, dtype=np.float64))
+    if not archive:
+        k_prime_l_quad = quantize_k_prime_l(k_prime_l_quad)
+    os.makedirs(directory, exist_ok=True)
+    sigmas = get_true_sigmas(k_prime_l_quad, beta_x, alpha_x, eps_x,
+                             beta_y, alpha_y, eps_y, lattice=lattice)
+    positions = ProfileGridData.get_sim_positions(npoints)
+    filenames = get_filenames(k_prime_l_quad)
+
+    archive_path = None
+    if archive:
+        from twissfit.archive import create_archive
+        archive_path = directory
+        create_archive(archive_path, k_prime_l_quad,
+                       np.stack((positions, positions)))
+
+    seed_seq = np.random.SeedSequence(seed)
+    starts = range(0, len(k_prime_l_quad), chunk_size)
+    chunks = [(directory, filenames[start:start + chunk_size], positions, sigmas[start:start + chunk_size],
+               child, noise, archive_path, start) for start, child in zip(starts, seed_seq.spawn(len(starts)))]
+    if jobs == 1 or len(chunks) == 1:
+        params = [_write_chunk(*chunk) for chunk in chunks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            params = list(executor.map(_write_chunk, *zip(*chunks)))
+    params = np.concatenate(params) if params else np.zeros((0, 2, 5))
+
+    if archive:
+        from twissfit.archive import write_archive_index
+        write_archive_index(archive_path, variant, filenames, [None] * len(filenames))
+
+    manifest = {'twiss': {'beta_x': beta_x, 'alpha_x': alpha_x, 'eps_x': eps_x,
+                          'beta_y': beta_y, 'alpha_y': alpha_y, 'eps_y': eps_y},
+                'seed': seed_seq.entropy,
+                'noise': noise,
+                'archive': archive,
+                'files': [{'filename': filename,
+                           'k_prime_l_quad': kl,
+                           'popt_x': param[0].tolist(),
+                           'popt_y': param[1].tolist()}
+                          for filename, kl, param in zip(filenames, k_prime_l_quad.tolist(), params)]}
+    with open(os.path.join(directory, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic campaign with known Twiss parameters.')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='Directory of the campaign.')
+    parser.add_argument('--twiss', nargs=6, type=float, required=True,
+                        metavar=('BETA_X', 'ALPHA_X', 'EPS_X',
+                                 'BETA_Y', 'ALPHA_Y', 'EPS_Y'),
+                        help='Twiss parameters at the reference plane.')
+    parser.add_argument('--k-prime-l', nargs=3, type=float, required=True,
+                        metavar=('START', 'STOP', 'NUM'), help='Range of K\'L values.')
+    parser.add_argument('--npoints', type=int, default=None,
+                        help='Number of channels per plane.')
+    parser.add_argument('--noise', type=float, default=0.01,
+                        help='Noise relative to the amplitude.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for reproducible campaigns.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes, 0 uses all cores.')
+    parser.add_argument('--archive', type=int, default=None, metavar='VARIANT',
+                        help='Write an archive of this variant instead of files.')
+    parser.add_argument('-i', '--init', type=str, default=None,
+                        help='Init file with an optional lattice.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Increase output verbosity')
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.basicConfig(level=log.INFO)
+
+    lattice = None
+    if args.init:
+        from twissfit.lattice import Lattice
+        with open(args.init, 'r') as f:
+            lattice = Lattice.from_init_dict(json.load(f), args.init)
+    start, stop, num = args.k_prime_l
+    k_prime_l_quad = np.linspace(start, stop, int(num))
+    try:
+        write_campaign(args.output, k_prime_l_quad, *args.twiss, npoints=args.npoints, noise=args.noise,
+                       seed=args.seed, jobs=args.jobs or os.cpu_count(), archive=args.archive is not None,
+                       variant=args.archive, lattice=lattice)
+    except ValueError as e:
+        print('{} Aborting.'.format(e))
+        sys.exit(1)
+    print('{} profiles written to {}'.format(len(k_prime_l_quad), args.output))
+
+
+if __name__ == '__main__':
+    main()
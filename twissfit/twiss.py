@@ -16,9 +16,12 @@ In the above reference, B, A and C are beta, alpha and gamma Twiss / Courant-Sny
 
 """
 
+import os
 import numpy as np
 import logging as log
-import matplotlib.pyplot as plt
+from twissfit.plotting import get_pyplot
+from twissfit.profiling import profiler
+from collections import OrderedDict
 
 L_DRIFT = 2.216  # m
 L_GEO_QUAD = 1  # m
@@ -26,6 +29,9 @@ R_QUAD = 0.085  # m
 I1A_NORM = 0.00092
 BRHO = 8.151048  # Tm
 B = -0.23044572  # T
+MATRIX_CACHE_SIZE = 256
+# resamples per random stream of the Monte Carlo uncertainties
+SAMPLE_BLOCK = 1000
 
 
 def get_gamma(beta, alpha):
@@ -73,17 +79,10 @@ def get_xfer_vert(ff, mq_vert, ldrift):
 
 
 def get_twiss_matrix(xfer):
-    ss = np.array([])
-    ss = np.append(ss, xfer[0, 0]**2)
-    ss = np.append(ss, -2 * xfer[0, 0] * xfer[0, 1])
-    ss = np.append(ss, xfer[0, 1]**2)
-    ss = np.append(ss, -xfer[0, 0] * xfer[1, 0])
-    ss = np.append(ss, xfer[0, 0] * xfer[1, 1] + xfer[0, 1] * xfer[1, 0])
-    ss = np.append(ss, -xfer[0, 1] * xfer[1, 1])
-    ss = np.append(ss, xfer[1, 0]**2)
-    ss = np.append(ss, -2 * xfer[1, 0] * xfer[1, 1])
-    ss = np.append(ss, xfer[1, 1]**2)
-    return np.reshape(ss, (3, 3))
+    return np.array([[xfer[0, 0]**2, -2 * xfer[0, 0] * xfer[0, 1], xfer[0, 1]**2],
+                     [-xfer[0, 0] * xfer[1, 0], xfer[0, 0] * xfer[1, 1] +
+                      xfer[0, 1] * xfer[1, 0], -xfer[0, 1] * xfer[1, 1]],
+                     [xfer[1, 0]**2, -2 * xfer[1, 0] * xfer[1, 1], xfer[1, 1]**2]])
 
 
 def transform(beta0, alpha0, xfer):
@@ -95,31 +94,507 @@ def transform(beta0, alpha0, xfer):
     return beta1, alpha1, gamma1
 
 
+# ------ cached versions, for repeated use of the same K'L and drift lengths
+
+
+class MatrixCache(object):
+    """
+    Bounded LRU cache for element and composite transfer matrices.
+    Cached matrices are read only.
+    """
+
+    def __init__(self, maxsize=MATRIX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, factory):
+        try:
+            value = self._data[key]
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        self.misses += 1
+        value = np.array(factory())
+        value.flags.writeable = False
+        if self.maxsize > 0:
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        while len(self._data) > max(maxsize, 0):
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'maxsize': self.maxsize, 'currsize': len(self._data)}
+
+    def __len__(self):
+        return len(self._data)
+
+
+matrix_cache = MatrixCache()
+
+
+def get_drift_cached(ldrift):
+    ldrift = float(ldrift)
+    return matrix_cache.get(('drift', ldrift), lambda: get_drift(ldrift))
+
+
+def get_ff_cached(k_prime_l_quad):
+    k_prime_l_quad = float(k_prime_l_quad)
+    return matrix_cache.get(('ff', k_prime_l_quad), lambda: get_ff(k_prime_l_quad))
+
+
+def get_mq_hor_cached(k_prime_l_quad):
+    k_prime_l_quad = float(k_prime_l_quad)
+    return matrix_cache.get(('mq_hor', k_prime_l_quad),
+                            lambda: get_mq_hor(get_kappa_quad(k_prime_l_quad)))
+
+
+def get_mq_vert_cached(k_prime_l_quad):
+    k_prime_l_quad = float(k_prime_l_quad)
+    return matrix_cache.get(('mq_vert', k_prime_l_quad),
+                            lambda: get_mq_vert(get_kappa_quad(k_prime_l_quad)))
+
+
+def get_xfer_hor_cached(k_prime_l_quad, ldrift=L_DRIFT):
+    k_prime_l_quad = float(k_prime_l_quad)
+    ldrift = float(ldrift)
+
+    def factory():
+        ff = get_ff_cached(k_prime_l_quad)
+        return get_drift_cached(ldrift) @ np.flip(ff).T @ get_mq_hor_cached(k_prime_l_quad) @ ff
+    return matrix_cache.get(('xfer_hor', k_prime_l_quad, ldrift), factory)
+
+
+def get_xfer_vert_cached(k_prime_l_quad, ldrift=L_DRIFT):
+    k_prime_l_quad = float(k_prime_l_quad)
+    ldrift = float(ldrift)
+
+    def factory():
+        ff = get_ff_cached(k_prime_l_quad)
+        return get_drift_cached(ldrift) @ ff @ get_mq_vert_cached(k_prime_l_quad) @ np.flip(ff).T
+    return matrix_cache.get(('xfer_vert', k_prime_l_quad, ldrift), factory)
+
+
+def get_design_row_cached(k_prime_l_quad, ldrift=L_DRIFT):
+    """
+    Cached first rows of the Twiss matrices of both planes for one K'L,
+    shape (2, 3) with the horizontal plane first.
+    """
+    k_prime_l_quad = float(k_prime_l_quad)
+    ldrift = float(ldrift)
+    return matrix_cache.get(('design_row', k_prime_l_quad, ldrift),
+                            lambda: get_design_matrices([k_prime_l_quad], ldrift)[:, 0])
+
+
+def get_design_matrices_cached(k_prime_l_quad, ldrift=L_DRIFT):
+    """
+    Design matrices as in get_design_matrices, assembled from the cached
+    rows of the distinct K'L settings, so that repeated solves over the
+    same settings become lookups. Only the small per setting rows are
+    cached, never the arrays of a whole campaign. Campaigns with more
+    distinct settings than the cache can hold are calculated directly.
+    """
+    k_prime_l_quad = np.atleast_1d(np.asarray(k_prime_l_quad, dtype=np.float64))
+    values, inverse = np.unique(k_prime_l_quad, return_inverse=True)
+    if len(values) > matrix_cache.maxsize:
+        return get_design_matrices(k_prime_l_quad, ldrift)
+    rows = np.stack([get_design_row_cached(kl, ldrift) for kl in values.tolist()])
+    # shape (..., N, 2, 3) to (..., 2, N, 3)
+    return np.moveaxis(rows[inverse.reshape(k_prime_l_quad.shape)], -2, -3)
+
+
+def set_cache_size(maxsize):
+    matrix_cache.resize(maxsize)
+
+
+def get_cache_info():
+    return matrix_cache.info()
+
+
+def clear_cache():
+    matrix_cache.clear()
+
+
+# ------ batched versions, operating on arrays of K'L and drift lengths
+
+
+def get_drift_batch(ldrift):
+    ldrift = np.atleast_1d(np.asarray(ldrift, dtype=np.float64))
+    drift = np.zeros((len(ldrift), 2, 2))
+    drift[:, 0, 0] = 1
+    drift[:, 0, 1] = ldrift
+    drift[:, 1, 1] = 1
+    return drift
+
+
+def get_ff_batch(k_prime_l_quad):
+    k_prime_l_quad = np.atleast_1d(np.asarray(k_prime_l_quad, dtype=np.float64))
+    ff = np.zeros((len(k_prime_l_quad), 2, 2))
+    ff[:, 0, 0] = 1 - I1A_NORM * k_prime_l_quad / L_GEO_QUAD
+    ff[:, 1, 1] = 1 + I1A_NORM * k_prime_l_quad / L_GEO_QUAD
+    return ff
+
+
+def get_mq_hor_batch(kappa_quad):
+    kappa_quad = np.atleast_1d(np.asarray(kappa_quad, dtype=np.float64))
+    mq = np.empty((len(kappa_quad), 2, 2))
+    mq[:, 0, 0] = np.cosh(kappa_quad * L_GEO_QUAD)
+    mq[:, 0, 1] = 1 / kappa_quad * np.sinh(kappa_quad * L_GEO_QUAD)
+    mq[:, 1, 0] = kappa_quad * np.sinh(kappa_quad * L_GEO_QUAD)
+    mq[:, 1, 1] = mq[:, 0, 0]
+    return mq
+
+
+def get_mq_vert_batch(kappa_quad):
+    kappa_quad = np.atleast_1d(np.asarray(kappa_quad, dtype=np.float64))
+    mq = np.empty((len(kappa_quad), 2, 2))
+    mq[:, 0, 0] = np.cos(kappa_quad * L_GEO_QUAD)
+    mq[:, 0, 1] = 1 / kappa_quad * np.sin(kappa_quad * L_GEO_QUAD)
+    mq[:, 1, 0] = -kappa_quad * np.sin(kappa_quad * L_GEO_QUAD)
+    mq[:, 1, 1] = mq[:, 0, 0]
+    return mq
+
+
+def _flip_batch(mat):
+    # batched equivalent of np.flip(mat).T for a stack of 2x2 matrices
+    return np.swapaxes(mat[:, ::-1, ::-1], 1, 2)
+
+
+def get_xfer_hor_batch(k_prime_l_quad, ldrift):
+    """
+    Stacked (N, 2, 2) horizontal transfer matrices. K'L and drift lengths
+    are broadcast against each other.
+    """
+    k_prime_l_quad, ldrift = np.broadcast_arrays(
+        np.atleast_1d(k_prime_l_quad), np.atleast_1d(ldrift))
+    ff = get_ff_batch(k_prime_l_quad)
+    mq = get_mq_hor_batch(get_kappa_quad(k_prime_l_quad))
+    return get_drift_batch(ldrift) @ _flip_batch(ff) @ mq @ ff
+
+
+def get_xfer_vert_batch(k_prime_l_quad, ldrift):
+    """
+    Stacked (N, 2, 2) vertical transfer matrices. K'L and drift lengths
+    are broadcast against each other.
+    """
+    k_prime_l_quad, ldrift = np.broadcast_arrays(
+        np.atleast_1d(k_prime_l_quad), np.atleast_1d(ldrift))
+    ff = get_ff_batch(k_prime_l_quad)
+    mq = get_mq_vert_batch(get_kappa_quad(k_prime_l_quad))
+    return get_drift_batch(ldrift) @ ff @ mq @ _flip_batch(ff)
+
+
+def get_xfer_batch(k_prime_l_quad, ldrift):
+    """
+    Horizontal and vertical stacked transfer matrices, sharing the
+    quadrupole and fringe field evaluation for both planes.
+    """
+    k_prime_l_quad, ldrift = np.broadcast_arrays(
+        np.atleast_1d(k_prime_l_quad), np.atleast_1d(ldrift))
+    ff = get_ff_batch(k_prime_l_quad)
+    ff_flip = _flip_batch(ff)
+    kappa_quad = get_kappa_quad(k_prime_l_quad)
+    drift = get_drift_batch(ldrift)
+    xfer_hor = drift @ ff_flip @ get_mq_hor_batch(kappa_quad) @ ff
+    xfer_vert = drift @ ff @ get_mq_vert_batch(kappa_quad) @ ff_flip
+    return xfer_hor, xfer_vert
+
+
+def get_twiss_matrix_batch(xfer):
+    """
+    Stacked (N, 3, 3) Twiss matrices from (N, 2, 2) transfer matrices.
+    """
+    m00 = xfer[:, 0, 0]
+    m01 = xfer[:, 0, 1]
+    m10 = xfer[:, 1, 0]
+    m11 = xfer[:, 1, 1]
+    ss = np.empty((len(xfer), 3, 3))
+    ss[:, 0, 0] = m00**2
+    ss[:, 0, 1] = -2 * m00 * m01
+    ss[:, 0, 2] = m01**2
+    ss[:, 1, 0] = -m00 * m10
+    ss[:, 1, 1] = m00 * m11 + m01 * m10
+    ss[:, 1, 2] = -m01 * m11
+    ss[:, 2, 0] = m10**2
+    ss[:, 2, 1] = -2 * m10 * m11
+    ss[:, 2, 2] = m11**2
+    return ss
+
+
+def transform_batch(beta0, alpha0, xfer):
+    """
+    Propagate Twiss parameters through a stack of transfer matrices.
+    beta0 and alpha0 may be scalars or arrays broadcastable to the stack.
+    Returns arrays of beta1, alpha1 and gamma1.
+    """
+    inp = np.stack(np.broadcast_arrays(
+        beta0, alpha0, get_gamma(beta0, alpha0)), axis=-1)
+    mat = (get_twiss_matrix_batch(xfer) @ inp[..., np.newaxis])[..., 0]
+    return mat[..., 0], mat[..., 1], mat[..., 2]
+
+
+def get_twiss_at_quad_exit(k_prime_l_quad, beta_x, alpha_x, beta_y, alpha_y):
+    """
+    Propagate the Twiss parameters through the quadrupole only, i.e. with
+    zero drift. Returns (beta, alpha, gamma) for each plane.
+    """
+    twiss_x = transform(beta_x, alpha_x, get_xfer_hor_cached(k_prime_l_quad, 0))
+    twiss_y = transform(beta_y, alpha_y, get_xfer_vert_cached(k_prime_l_quad, 0))
+    return twiss_x, twiss_y
+
+
+def get_sigma_envelope(k_prime_l_quad, l_iter, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y):
+    """
+    Beam size for a fixed K'L on an arbitrary grid of drift lengths behind
+    the quadrupole. In a drift beta(L) = beta0 - 2 alpha0 L + gamma0 L^2,
+    so the quadrupole is passed only once and the rest is closed form.
+    """
+    l_iter = np.asarray(l_iter, dtype=np.float64)
+    (bx, ax, gx), (by, ay, gy) = get_twiss_at_quad_exit(
+        k_prime_l_quad, beta_x, alpha_x, beta_y, alpha_y)
+    sigma_x_array = get_sigma(bx - 2 * ax * l_iter + gx * l_iter**2, eps_x)
+    sigma_y_array = get_sigma(by - 2 * ay * l_iter + gy * l_iter**2, eps_y)
+    return sigma_x_array, sigma_y_array
+
+
+def _fill_sigma_map_tile(sigma_map, start, kl_tile, l_iter, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y):
+    # Twiss parameters at the quadrupole exit for all K'L of the tile, then
+    # closed form in the drift
+    xfer_hor, xfer_vert = get_xfer_batch(kl_tile, 0)
+    stop = start + len(kl_tile)
+    for plane, (beta, alpha, eps, xfer) in enumerate(((beta_x, alpha_x, eps_x, xfer_hor), (beta_y, alpha_y, eps_y, xfer_vert))):
+        b, a, g = transform_batch(beta, alpha, xfer)
+        sigma_map[plane, start:stop] = get_sigma(
+            b[:, np.newaxis] - 2 * a[:, np.newaxis] * l_iter + g[:, np.newaxis] * l_iter**2, eps)
+
+
+def _sigma_map_worker(filename, start, kl_tile, l_iter, *twiss):
+    sigma_map = np.load(filename, mmap_mode='r+')
+    _fill_sigma_map_tile(sigma_map, start, kl_tile, l_iter, *twiss)
+    sigma_map.flush()
+
+
+def get_sigma_map(kl_iter, l_iter, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y, jobs=1, filename=None, tile_size=256):
+    """
+    Beam size on a grid of K'L and drift lengths, shape (2, len(kl_iter),
+    len(l_iter)) with the horizontal plane first. The K'L axis is split in
+    tiles, which can be distributed over worker processes. If a filename is
+    given, the map is written to a memory mapped .npy file.
+    """
+    kl_iter = np.asarray(kl_iter, dtype=np.float64)
+    l_iter = np.asarray(l_iter, dtype=np.float64)
+    shape = (2, len(kl_iter), len(l_iter))
+    twiss = (beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y)
+    starts = range(0, len(kl_iter), tile_size)
+
+    if jobs is not None and jobs <= 0:
+        jobs = os.cpu_count()
+    if filename is not None and jobs and jobs > 1 and len(starts) > 1:
+        np.lib.format.open_memmap(filename, mode='w+', shape=shape).flush()
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(jobs, len(starts))) as executor:
+            futures = [executor.submit(_sigma_map_worker, filename, start,
+                                       kl_iter[start:start + tile_size], l_iter, *twiss)
+                       for start in starts]
+            for future in futures:
+                future.result()
+        return np.load(filename, mmap_mode='r')
+
+    if filename is not None:
+        sigma_map = np.lib.format.open_memmap(filename, mode='w+', shape=shape)
+    else:
+        sigma_map = np.empty(shape)
+    if jobs and jobs > 1 and len(starts) > 1:
+        # without a file, the workers send back their tiles
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(jobs, len(starts))) as executor:
+            futures = [executor.submit(get_sigma_map, kl_iter[start:start + tile_size], l_iter, *twiss)
+                       for start in starts]
+            for start, future in zip(starts, futures):
+                tile = future.result()
+                sigma_map[:, start:start + tile.shape[1]] = tile
+    else:
+        for start in starts:
+            _fill_sigma_map_tile(sigma_map, start, kl_iter[start:start + tile_size], l_iter, *twiss)
+    return sigma_map
+
+
+def get_sigma_map_minima(sigma_map, kl_iter, l_iter):
+    """
+    Position of the smallest beam size per plane as a list of
+    (K'L, drift length, sigma) tuples, horizontal plane first. A plane
+    without any finite beam size, e.g. for an unphysical solution with
+    negative emittance, gives NaN.
+    """
+    minima = []
+    for plane in range(2):
+        if not np.isfinite(sigma_map[plane]).any():
+            log.warning('No finite beam size in plane {}, the solution is probably unphysical.'.format(
+                ('x', 'y')[plane]))
+            minima.append((np.nan, np.nan, np.nan))
+            continue
+        i, j = np.unravel_index(np.nanargmin(sigma_map[plane]), sigma_map[plane].shape)
+        minima.append((kl_iter[i], l_iter[j], sigma_map[plane, i, j]))
+    return minima
+
+
+def get_xfer_batch_derivative(k_prime_l_quad, ldrift):
+    """
+    Derivatives of the horizontal and vertical stacked transfer matrices
+    with respect to K'L.
+    """
+    k_prime_l_quad, ldrift = np.broadcast_arrays(
+        np.atleast_1d(k_prime_l_quad), np.atleast_1d(ldrift))
+    ff = get_ff_batch(k_prime_l_quad)
+    ff_flip = _flip_batch(ff)
+    dff = np.zeros_like(ff)
+    dff[:, 0, 0] = -I1A_NORM / L_GEO_QUAD
+    dff[:, 1, 1] = I1A_NORM / L_GEO_QUAD
+    dff_flip = _flip_batch(dff)
+
+    kappa_quad = get_kappa_quad(k_prime_l_quad)
+    dkappa = 1 / (2 * L_GEO_QUAD * kappa_quad)
+    kl = kappa_quad * L_GEO_QUAD
+    dmq_hor = np.empty_like(ff)
+    dmq_hor[:, 0, 0] = L_GEO_QUAD * np.sinh(kl)
+    dmq_hor[:, 0, 1] = (kl * np.cosh(kl) - np.sinh(kl)) / kappa_quad**2
+    dmq_hor[:, 1, 0] = np.sinh(kl) + kl * np.cosh(kl)
+    dmq_hor[:, 1, 1] = dmq_hor[:, 0, 0]
+    dmq_hor *= dkappa[:, np.newaxis, np.newaxis]
+    dmq_vert = np.empty_like(ff)
+    dmq_vert[:, 0, 0] = -L_GEO_QUAD * np.sin(kl)
+    dmq_vert[:, 0, 1] = (kl * np.cos(kl) - np.sin(kl)) / kappa_quad**2
+    dmq_vert[:, 1, 0] = -(np.sin(kl) + kl * np.cos(kl))
+    dmq_vert[:, 1, 1] = dmq_vert[:, 0, 0]
+    dmq_vert *= dkappa[:, np.newaxis, np.newaxis]
+
+    drift = get_drift_batch(ldrift)
+    mq_hor = get_mq_hor_batch(kappa_quad)
+    mq_vert = get_mq_vert_batch(kappa_quad)
+    dxfer_hor = drift @ (dff_flip @ mq_hor @ ff + ff_flip @
+                         dmq_hor @ ff + ff_flip @ mq_hor @ dff)
+    dxfer_vert = drift @ (dff @ mq_vert @ ff_flip + ff @
+                          dmq_vert @ ff_flip + ff @ mq_vert @ dff_flip)
+    return dxfer_hor, dxfer_vert
+
+
+def get_beta_and_derivative(k_prime_l_quad, ldrift, beta_x, alpha_x, beta_y, alpha_y):
+    """
+    Beta at the end of the drift and its derivative with respect to K'L,
+    each of shape (2, N) with the horizontal plane first.
+    """
+    xfers = get_xfer_batch(k_prime_l_quad, ldrift)
+    dxfers = get_xfer_batch_derivative(k_prime_l_quad, ldrift)
+    betas = []
+    dbetas = []
+    for xfer, dxfer, beta0, alpha0 in zip(xfers, dxfers, (beta_x, beta_y), (alpha_x, alpha_y)):
+        gamma0 = get_gamma(beta0, alpha0)
+        m00, m01 = xfer[:, 0, 0], xfer[:, 0, 1]
+        dm00, dm01 = dxfer[:, 0, 0], dxfer[:, 0, 1]
+        betas.append(m00**2 * beta0 - 2 * m00 * m01 * alpha0 + m01**2 * gamma0)
+        dbetas.append(2 * m00 * dm00 * beta0 - 2 * (dm00 * m01 + m00 * dm01) * alpha0 +
+                      2 * m01 * dm01 * gamma0)
+    return np.array(betas), np.array(dbetas)
+
+
+def _find_roots(func, kl_grid, values):
+    # refine all sign changes on the grid with bracketed root finding
+    from scipy.optimize import brentq
+    roots = []
+    for i in np.flatnonzero(np.sign(values[:-1]) * np.sign(values[1:]) < 0):
+        roots.append(brentq(func, kl_grid[i], kl_grid[i + 1], xtol=1e-12))
+    roots.extend(kl_grid[values == 0])
+    return np.sort(np.array(roots))
+
+
+def optimize_k_prime_l(beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y, weights=(1, 1), ldrift=L_DRIFT, kl_range=(0.01, 2), ngrid=64):
+    """
+    Find the K'L within kl_range, which minimizes the weighted sum
+    w_x sigma_x^2 + w_y sigma_y^2 at the profile grid. Use weights (1, 0)
+    or (0, 1) for a single plane. The zeros of the analytic derivative are
+    bracketed on a coarse grid and refined with Brent's method.
+
+    Returns K'L, sigma_x and sigma_y. Raises ValueError if the objective
+    is not finite, e.g. for a weighted plane with negative emittance.
+    """
+    weights = np.array(weights, dtype=np.float64)
+    # planes without weight must not spread NaN into the objective
+    planes = weights != 0
+    if not planes.any():
+        raise ValueError('At least one weight must be non zero.')
+    weights = weights[planes] * np.array([eps_x, eps_y])[planes]
+    twiss = (beta_x, alpha_x, beta_y, alpha_y)
+
+    def derivative(kl):
+        _, dbeta = get_beta_and_derivative(kl, ldrift, *twiss)
+        return float(weights @ dbeta[planes, 0])
+
+    kl_grid = np.linspace(kl_range[0], kl_range[1], ngrid)
+    beta, dbeta = get_beta_and_derivative(kl_grid, ldrift, *twiss)
+    if not np.all(np.isfinite(weights @ beta[planes])):
+        raise ValueError(
+            'Objective is not finite, the solution of a weighted plane is probably unphysical.')
+    candidates = np.concatenate(
+        (_find_roots(derivative, kl_grid, weights @ dbeta[planes]), kl_range))
+    beta, _ = get_beta_and_derivative(candidates, ldrift, *twiss)
+    best = np.argmin(weights @ beta[planes])
+    return (candidates[best], get_sigma(beta[0, best], eps_x),
+            get_sigma(beta[1, best], eps_y))
+
+
+def find_k_prime_l_for_sigma(target, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y, plane=0, ldrift=L_DRIFT, kl_range=(0.01, 2), ngrid=64):
+    """
+    All K'L within kl_range for which sigma of the given plane (0 for
+    horizontal, 1 for vertical) equals the target value.
+    """
+    eps = (eps_x, eps_y)[plane]
+    twiss = (beta_x, alpha_x, beta_y, alpha_y)
+
+    def difference(kl):
+        beta, _ = get_beta_and_derivative(kl, ldrift, *twiss)
+        return float(get_sigma(beta[plane, 0], eps) - target)
+
+    kl_grid = np.linspace(kl_range[0], kl_range[1], ngrid)
+    beta, _ = get_beta_and_derivative(kl_grid, ldrift, *twiss)
+    return _find_roots(difference, kl_grid, get_sigma(beta[plane], eps) - target)
+
+
 def get_epsilon(X):
     return np.sqrt(X[0] * X[2] - X[1]**2)
 
 
-def plot_sigma_vs_k_prime_l(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y):
+def plot_sigma_vs_k_prime_l(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y, lattice=None, output=None):
+    plt = get_pyplot()
     k_prime_l_quad_max = result_matrix.max(axis=0)[0] * (1 + 0.1)
     kl_iter = np.linspace(0.01, k_prime_l_quad_max, 200)
-    sigma_x_array = np.array([])
-    sigma_y_array = np.array([])
-
-    for kl in kl_iter:
-        kappa_quad = get_kappa_quad(kl)
-        ff = get_ff(kl)
-        # x-plane
-        xfer_hor = get_xfer_hor(ff, get_mq_hor(kappa_quad), L_DRIFT)
-        beta_x_at_l, alpha_x_at_l, _ = transform(beta_x, alpha_x, xfer_hor)
-        sigma_x_array = np.append(sigma_x_array, get_sigma(beta_x_at_l, eps_x))
-
-    for kl in kl_iter:
-        kappa_quad = get_kappa_quad(kl)
-        ff = get_ff(kl)
-        # y-plane
-        xfer_vert = get_xfer_vert(ff, get_mq_vert(kappa_quad), L_DRIFT)
-        beta_y_at_l, alpha_y_at_l, _ = transform(beta_y, alpha_y, xfer_vert)
-        sigma_y_array = np.append(sigma_y_array, get_sigma(beta_y_at_l, eps_y))
+    if lattice is None:
+        xfer_hor, xfer_vert = get_xfer_batch(kl_iter, L_DRIFT)
+        title = "Sigma vs. K'L @ {} m from ref. plane".format(L_DRIFT)
+    else:
+        xfer_hor, xfer_vert = lattice.get_xfer_batch(kl_iter)
+        title = "Sigma vs. K'L @ profile grid"
+
+    # x-plane
+    beta_x_at_l, _, _ = transform_batch(beta_x, alpha_x, xfer_hor)
+    sigma_x_array = get_sigma(beta_x_at_l, eps_x)
+
+    # y-plane
+    beta_y_at_l, _, _ = transform_batch(beta_y, alpha_y, xfer_vert)
+    sigma_y_array = get_sigma(beta_y_at_l, eps_y)
 
     fig = plt.figure()
     ax = fig.gca()
@@ -131,7 +606,7 @@ def plot_sigma_vs_k_prime_l(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha
             'bs', label='sigma_y data')
     ax.set_xlabel("K'L")
     ax.set_ylabel("sigma [mm]")
-    ax.set_title("Sigma vs. K'L @ {} m from ref. plane".format(L_DRIFT))
+    ax.set_title(title)
     # Now add the legend with some customizations.
     legend = ax.legend(loc='upper right', shadow=False)
 
@@ -140,33 +615,22 @@ def plot_sigma_vs_k_prime_l(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha
         label.set_fontsize('small')
 
     ax.grid(True)
-    plot_filename = 'sigma_K_L_at_{}.pdf'.format(L_DRIFT)
-    plt.savefig(plot_filename)
+    # output can be a file like object instead of the default file name
+    plot_filename = output if output is not None else 'sigma_K_L_at_{}.pdf'.format(
+        L_DRIFT)
+    fig.savefig(plot_filename, format='pdf')
+    plt.close(fig)
     return plot_filename
 
 
-def plot_sigma_vs_distance(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y):
+def plot_sigma_vs_distance(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y, l_iter=None, output=None):
+    plt = get_pyplot()
     # choose the first of the K'L that the user had input
     kl = result_matrix[0, 0]
-    sigma_x_array = np.array([])
-    sigma_y_array = np.array([])
-
-    l_iter = np.arange(0.1, 5, 0.1)  # every 10 centemeters
-    for ll in l_iter:
-        kappa_quad = get_kappa_quad(kl)
-        ff = get_ff(kl)
-        # x-plane
-        xfer_hor = get_xfer_hor(ff, get_mq_hor(kappa_quad), ll)
-        beta_x_at_l, alpha_x_at_l, _ = transform(beta_x, alpha_x, xfer_hor)
-        sigma_x_array = np.append(sigma_x_array, get_sigma(beta_x_at_l, eps_x))
-
-    for ll in l_iter:
-        kappa_quad = get_kappa_quad(kl)
-        ff = get_ff(kl)
-        # y-plane
-        xfer_vert = get_xfer_vert(ff, get_mq_vert(kappa_quad), ll)
-        beta_y_at_l, alpha_y_at_l, _ = transform(beta_y, alpha_y, xfer_vert)
-        sigma_y_array = np.append(sigma_y_array, get_sigma(beta_y_at_l, eps_y))
+    if l_iter is None:
+        l_iter = np.arange(0.1, 5, 0.1)  # every 10 centemeters
+    sigma_x_array, sigma_y_array = get_sigma_envelope(
+        kl, l_iter, beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y)
 
     fig = plt.figure()
     ax = fig.gca()
@@ -183,70 +647,207 @@ def plot_sigma_vs_distance(result_matrix, beta_x, alpha_x, eps_x, beta_y, alpha_
         label.set_fontsize('small')
 
     ax.grid(True)
-    plot_filename = 'sigma_distance_at_K_L_{}.pdf'.format(kl)
-    plt.savefig(plot_filename)
+    # output can be a file like object instead of the default file name
+    plot_filename = output if output is not None else 'sigma_distance_at_K_L_{}.pdf'.format(
+        kl)
+    fig.savefig(plot_filename, format='pdf')
+    plt.close(fig)
     return plot_filename
 
 # ------
 
 
-def solve_equation_system(result_matrix):
-    nrows, ncols = np.shape(result_matrix)
-
-    # solving a X = b for x-plane
-    a_hor = np.array([])
-    b_hor = np.array([])
-    a_vert = np.array([])
-    b_vert = np.array([])
-
-    for row in result_matrix:
-        k_prime_l_quad = row[0]
-        kappa_quad = get_kappa_quad(k_prime_l_quad)
-        ff = get_ff(k_prime_l_quad)
-        sigma_x = row[1]
-        xfer_hor = get_xfer_hor(ff, get_mq_hor(kappa_quad), L_DRIFT)
-        tw_hor = get_twiss_matrix(xfer_hor)
-        a_hor = np.append(a_hor, (tw_hor[0, 0], tw_hor[0, 1], tw_hor[0, 2]))
-        b_hor = np.append(b_hor, sigma_x ** 2)
-    a_hor = np.reshape(a_hor, (nrows, 3))
-    X_hor, res_hor, _, _ = np.linalg.lstsq(a_hor, b_hor, rcond=None)
-
-    beta_x = X_hor[0] / get_epsilon(X_hor)
-    alpha_x = X_hor[1] / get_epsilon(X_hor)
-    gamma_x = X_hor[2] / get_epsilon(X_hor)
-    eps_x = get_epsilon(X_hor)
+def get_design_matrices(k_prime_l_quad, ldrift=L_DRIFT):
+    """
+    Design matrices for both planes, i.e. the first rows of the Twiss
+    matrices. k_prime_l_quad may have shape (N,) or (M, N), the result
+    then has shape (2, N, 3) or (M, 2, N, 3) with the horizontal plane first.
+    """
+    k_prime_l_quad = np.asarray(k_prime_l_quad, dtype=np.float64)
+    xfer_hor, xfer_vert = get_xfer_batch(k_prime_l_quad.ravel(), ldrift)
+    a_hor = get_twiss_matrix_batch(xfer_hor)[:, 0, :]
+    a_vert = get_twiss_matrix_batch(xfer_vert)[:, 0, :]
+    design = np.stack((a_hor, a_vert))
+    if k_prime_l_quad.ndim > 1:
+        design = design.reshape(
+            (2,) + k_prime_l_quad.shape + (3,)).swapaxes(0, -3)
+    return design
+
+
+def get_twiss_from_solution(X):
+    """
+    Convert solutions (beta*eps, alpha*eps, gamma*eps) along the last axis
+    to beta, alpha, gamma and eps.
+    """
+    eps = np.sqrt(X[..., 0] * X[..., 2] - X[..., 1]**2)
+    return X[..., 0] / eps, X[..., 1] / eps, X[..., 2] / eps, eps
+
+
+def solve_equation_system_batch(k_prime_l_quad, sigma_x, sigma_y, design=None):
+    """
+    Solve both planes in one batched least squares call.
+
+    k_prime_l_quad, sigma_x and sigma_y have shape (N,) for a single
+    measurement campaign or (M, N) for M independent campaigns. If all
+    campaigns share the same K'L settings, a (N,) k_prime_l_quad is enough
+    and the pseudo-inverse is calculated only once.
+
+    A precalculated design matrix can be passed to skip its construction.
+
+    Returns beta, alpha, gamma and eps, each of shape (..., 2) with the
+    horizontal plane first.
+    """
+    if design is None:
+        design = get_design_matrices(k_prime_l_quad)
+    b = np.stack(np.broadcast_arrays(
+        np.asarray(sigma_x) ** 2, np.asarray(sigma_y) ** 2), axis=-2)
+    X = (np.linalg.pinv(design) @ b[..., np.newaxis])[..., 0]
+    return get_twiss_from_solution(X)
+
+
+def get_campaign_design_matrices(k_prime_l_quad, lattice=None):
+    """
+    Design matrices of a campaign, for the default beam line from the
+    cache or for the given twissfit.lattice.Lattice.
+    """
+    if lattice is None:
+        return get_design_matrices_cached(k_prime_l_quad)
+    return lattice.get_design_matrices(k_prime_l_quad)
+
+
+def solve_equation_system(result_matrix, lattice=None):
+    with profiler.stage('solve'):
+        beta, alpha, gamma, eps = solve_equation_system_batch(
+            result_matrix[:, 0], result_matrix[:, 1], result_matrix[:, 2],
+            design=get_campaign_design_matrices(result_matrix[:, 0], lattice))
+    beta_x, beta_y = beta
+    alpha_x, alpha_y = alpha
+    gamma_x, gamma_y = gamma
+    eps_x, eps_y = eps
 
     log.info('Results:')
     log.info('beta_x = {}'.format(beta_x))
     log.info('alpha_x = {}'.format(alpha_x))
     log.info('gamma_x = {}'.format(gamma_x))
     log.info('eps_x = {}'.format(eps_x))
-
-    # solving a X = b for y-plane
-    for row in result_matrix:
-        k_prime_l_quad = row[0]
-        kappa_quad = get_kappa_quad(k_prime_l_quad)
-        ff = get_ff(k_prime_l_quad)
-        sigma_y = row[2]
-        xfer_vert = get_xfer_vert(ff, get_mq_vert(kappa_quad), L_DRIFT)
-        tw_vert = get_twiss_matrix(xfer_vert)
-        a_vert = np.append(
-            a_vert, (tw_vert[0, 0], tw_vert[0, 1], tw_vert[0, 2]))
-        b_vert = np.append(b_vert, sigma_y ** 2)
-    a_vert = np.reshape(a_vert, (nrows, 3))
-    X_vert, res_vert, _, _ = np.linalg.lstsq(a_vert, b_vert, rcond=None)
-
-    beta_y = X_vert[0] / get_epsilon(X_vert)
-    alpha_y = X_vert[1] / get_epsilon(X_vert)
-    gamma_y = X_vert[2] / get_epsilon(X_vert)
-    eps_y = get_epsilon(X_vert)
-
     log.info('beta_y = {}'.format(beta_y))
     log.info('alpha_y = {}'.format(alpha_y))
     log.info('gamma_y = {}'.format(gamma_y))
     log.info('eps_y = {}'.format(eps_y))
     return beta_x, alpha_x, eps_x, beta_y, alpha_y, eps_y
 
+
+def _solve_resamples(design, sigma_x, sigma_y, sigma_x_err, sigma_y_err, entropy, start, nsamples):
+    # resamples start to start + nsamples, solved as a single stacked system.
+    # each block of SAMPLE_BLOCK resamples has its own random stream, so the
+    # resamples do not depend on how they are split into chunks
+    nrows = len(sigma_x)
+    noise = np.empty((nsamples, 2, nrows))
+    for block_start in range(start, start + nsamples, SAMPLE_BLOCK):
+        nblock = min(SAMPLE_BLOCK, start + nsamples - block_start)
+        rng = np.random.default_rng(np.random.SeedSequence(
+            entropy, spawn_key=(block_start // SAMPLE_BLOCK,)))
+        noise[block_start - start:block_start - start + nblock] = rng.standard_normal((nblock, 2, nrows))
+    samples_x = sigma_x + sigma_x_err * noise[:, 0]
+    samples_y = sigma_y + sigma_y_err * noise[:, 1]
+    with np.errstate(invalid='ignore'):
+        return np.stack(solve_equation_system_batch(
+            None, samples_x, samples_y, design=design))
+
+
+def get_twiss_uncertainty(result_matrix, sigma_errors, nsamples=10000, seed=None, jobs=1, chunk_size=100000, lattice=None):
+    """
+    Monte Carlo propagation of the errors of the fitted beam sizes to the
+    Twiss parameters. sigma_errors has shape (N, 2) with the standard
+    deviations of sigma_x and sigma_y, e.g. the square root of the
+    diagonal sigma element of the fit covariance.
+
+    All resamples of a chunk are solved at once. With jobs > 1, the chunks
+    are distributed over worker processes. chunk_size is rounded to whole
+    blocks of SAMPLE_BLOCK resamples. With a seed, the results do not
+    depend on chunk_size and jobs.
+
+    Returns mean and standard deviation of beta, alpha, gamma and eps,
+    each of shape (4, 2) with the horizontal plane first, and the fraction
+    of resamples that gave a physical solution (positive emittance and
+    positive beta).
+    """
+    design = np.array(get_campaign_design_matrices(result_matrix[:, 0], lattice))
+    args = (design, result_matrix[:, 1], result_matrix[:, 2],
+            sigma_errors[:, 0], sigma_errors[:, 1], np.random.SeedSequence(seed).entropy)
+    chunk_size = max(1, chunk_size // SAMPLE_BLOCK) * SAMPLE_BLOCK
+    chunks = [(start, min(chunk_size, nsamples - start))
+              for start in range(0, nsamples, chunk_size)]
+
+    if jobs is not None and jobs <= 0:
+        jobs = os.cpu_count()
+    if not jobs or jobs == 1 or len(chunks) == 1:
+        results = [_solve_resamples(*args, start, nchunk)
+                   for start, nchunk in chunks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(jobs, len(chunks))) as executor:
+            futures = [executor.submit(_solve_resamples, *args, start, nchunk)
+                       for start, nchunk in chunks]
+            results = [future.result() for future in futures]
+
+    # shape (4, nsamples, 2)
+    samples = np.concatenate(results, axis=1)
+    valid = np.all(np.isfinite(samples), axis=0) & (samples[0] > 0)
+    samples = np.where(valid, samples, np.nan)
+    return np.nanmean(samples, axis=1), np.nanstd(samples, axis=1), valid.mean(axis=0)
+
+
+class IncrementalTwissSolver(object):
+    """
+    Least squares solution of both planes, updated one measurement at a
+    time. Only the 3x3 normal equations are kept, so adding a measurement
+    and solving take constant time regardless of the number of files.
+    """
+
+    def __init__(self, ldrift=L_DRIFT, lattice=None):
+        self.ldrift = ldrift
+        self.lattice = lattice
+        self.nrows = 0
+        self._ata = np.zeros((2, 3, 3))
+        self._atb = np.zeros((2, 3))
+
+    def add(self, k_prime_l_quad, sigma_x, sigma_y):
+        # rank one update of the normal equations of both planes
+        if self.lattice is None:
+            rows = get_design_matrices_cached(
+                [k_prime_l_quad], self.ldrift)[:, 0, :]
+        else:
+            rows = self.lattice.get_design_matrices([k_prime_l_quad])[:, 0, :]
+        b = np.array([sigma_x, sigma_y]) ** 2
+        self._ata += rows[:, :, np.newaxis] * rows[:, np.newaxis, :]
+        self._atb += rows * b[:, np.newaxis]
+        self.nrows += 1
+
+    def add_batch(self, k_prime_l_quad, sigma_x, sigma_y):
+        """
+        Add many measurements at once, e.g. a chunk of an archive.
+        """
+        k_prime_l_quad = np.asarray(k_prime_l_quad, dtype=np.float64)
+        if self.lattice is None:
+            rows = get_design_matrices(k_prime_l_quad, self.ldrift)
+        else:
+            rows = self.lattice.get_design_matrices(k_prime_l_quad)
+        b = np.array([sigma_x, sigma_y], dtype=np.float64) ** 2
+        self._ata += np.swapaxes(rows, 1, 2) @ rows
+        self._atb += (np.swapaxes(rows, 1, 2) @ b[..., np.newaxis])[..., 0]
+        self.nrows += len(k_prime_l_quad)
+
+    def solve(self):
+        """
+        Returns beta, alpha, gamma and eps, each of shape (2,) with the
+        horizontal plane first, or None if fewer than 3 measurements exist.
+        """
+        if self.nrows < 3:
+            return None
+        X = (np.linalg.pinv(self._ata) @ self._atb[..., np.newaxis])[..., 0]
+        return get_twiss_from_solution(X)
+
 # ---------
 
 